@@ -11,12 +11,77 @@ import { createClient } from "@/utils/supabase/client";
 import { io } from "socket.io-client";
 import {Sheet, SheetContent, SheetDescription, SheetHeader, SheetTitle} from "@/components/ui/sheet";
 
+// Each browser gets its own main conversation, the server only sends its responses to that room
+const getMainConversationId = () => {
+  if (typeof window === 'undefined') return 'main_chat';
+  let conversationId = window.localStorage.getItem('brainbase_conversation_id');
+  if (!conversationId) {
+    conversationId = `main_${crypto.randomUUID()}`;
+    window.localStorage.setItem('brainbase_conversation_id', conversationId);
+  }
+  return conversationId;
+};
+
 // Initialize socket connection with explicit configuration
 const socket = io('http://localhost:8000', {
   transports: ['websocket'],
   reconnection: true,
+  auth: (cb) => cb({ conversation_id: getMainConversationId() }),
+});
+
+// Per-conversation sequence numbers and last context, the server keeps the full history
+const sequenceNumbers = new Map<string, number>();
+const lastContexts = new Map<string, any>();
+
+// Last chat_message of each conversation, sent again when the server is busy
+const lastTurns = new Map<string, any>();
+
+const emitChatMessage = (payload: any) => {
+  lastTurns.set(payload.conversation_id, payload);
+  socket.emit('chat_message', payload);
+};
+
+// A busy server did not apply the turn, resend it unchanged unless a newer one was sent meanwhile
+const retryChatMessage = (response: any) => {
+  const payload = lastTurns.get(response.conversation_id);
+  if (!payload || payload.seq !== response.seq) return;
+  setTimeout(() => {
+    if (sequenceNumbers.get(payload.conversation_id) === payload.seq) {
+      emitChatMessage(payload);
+    }
+  }, response.retry_after * 1000);
+};
+
+// Send only the new message, if the server sees a gap it asks for a resync
+const sendChatMessage = (newMessage: MessageType, context: any) => {
+  const conversationId = newMessage.conversation_id as string;
+  const seq = (sequenceNumbers.get(conversationId) || 0) + 1;
+  sequenceNumbers.set(conversationId, seq);
+  lastContexts.set(conversationId, context);
+
+  emitChatMessage({
+    conversation_id: conversationId,
+    seq,
+    messages: [newMessage],
+    context
+  });
+};
+
+// Full offers are only fetched when a sheet opens, one request per offer
+const pendingDetails = new Map<string, (details: any) => void>();
+
+socket.on('result_details', (response: any) => {
+  const key = `${response.conversation_id}:${response.type}:${response.id}`;
+  pendingDetails.get(key)?.(response.status === 'success' ? response.data : null);
+  pendingDetails.delete(key);
 });
 
+const fetchResultDetails = (conversationId: string, type: string, id: string) =>
+  new Promise<any>((resolve) => {
+    pendingDetails.set(`${conversationId}:${type}:${id}`, resolve);
+    socket.emit('result_details', { conversation_id: conversationId, type, id });
+  });
+
 // Add these interfaces at the top of the file
 interface FlightPrice {
   total: string;
@@ -24,11 +89,40 @@ interface FlightPrice {
 
 interface MessageType {
   type?: string;
-  data?: FlightData[];
+  data?: (FlightSummary | HotelSummary)[];
   message: string;
   from: 'user' | 'ai';
   conversation_id?: string;
   parent_conversation_id?: string;
+  message_id?: string;
+  page?: number;
+  has_more?: boolean;
+}
+
+// Ranked result summaries sent by the server, the full offer is fetched on demand
+interface FlightSummary {
+  id: string;
+  origin: string;
+  destination: string;
+  departure: string;
+  arrival: string;
+  carrier: string;
+  flight_number: string;
+  duration: number | null;
+  stops: number;
+  price: number;
+  currency: string;
+}
+
+interface HotelSummary {
+  id: string;
+  name: string;
+  chain: string | null;
+  city: string | null;
+  latitude: number | null;
+  longitude: number | null;
+  country: string | null;
+  distance: number | null;
 }
 
 interface FlightLinks {
@@ -85,24 +179,68 @@ interface StepByStepState {
   content: string;
 }
 
+// Messages saved before results were summarized carry the full Amadeus payload
+const toFlightSummary = (item: FlightSummary | FlightData): FlightSummary => {
+  if (!('itineraries' in item)) return item;
+  const segments = item.itineraries[0].segments;
+  const [hours, minutes] = (item.itineraries[0].duration.match(/PT(?:(\d+)H)?(?:(\d+)M)?/) || []).slice(1);
+  return {
+    id: item.id,
+    origin: segments[0].departure.iataCode,
+    destination: segments[segments.length - 1].arrival.iataCode,
+    departure: segments[0].departure.at,
+    arrival: segments[segments.length - 1].arrival.at,
+    carrier: segments[0].carrierCode,
+    flight_number: `${segments[0].carrierCode}${segments[0].number}`,
+    duration: Number(hours || 0) * 60 + Number(minutes || 0),
+    stops: segments.length - 1,
+    price: Number(item.price.total),
+    currency: item.price.currency,
+  };
+};
+
+const toHotelSummary = (item: HotelSummary | HotelData): HotelSummary => {
+  if (!('hotelId' in item)) return item;
+  return {
+    id: item.hotelId,
+    name: item.name,
+    chain: item.chainCode,
+    city: item.iataCode,
+    latitude: item.geoCode?.latitude ?? null,
+    longitude: item.geoCode?.longitude ?? null,
+    country: item.address?.countryCode ?? null,
+    distance: null,
+  };
+};
+
+const formatDuration = (minutes: number | null) =>
+  minutes === null ? 'Unknown' : `${Math.floor(minutes / 60)}h ${minutes % 60}m`;
+
 // Add this component above the Home component
-const FlightCard = ({ flight, messages, setMessages, saveToSupabase }: { flight: FlightData, messages: MessageType[], setMessages: (messages: any) => void, saveToSupabase: (message: string, from: 'user' | 'ai', type: string|null, data: any|null, conversation_id?: string) => void  }) => {
+const FlightCard = ({ flight, messages, setMessages, saveToSupabase }: { flight: FlightSummary, messages: MessageType[], setMessages: (messages: any) => void, saveToSupabase: (message: string, from: 'user' | 'ai', type: string|null, data: any|null, conversation_id?: string) => void  }) => {
   const [isOpen, setIsOpen] = useState(false);
   const [sheetMessage, setSheetMessage] = useState("");
+  const [details, setDetails] = useState<FlightData | null>(null);
   
   // Get the parent conversation ID from the most recent flight search message
   const parentConversationId = messages
     .filter(msg => msg.type === 'flight-results')
-    .pop()?.conversation_id || 'main_chat';
+    .pop()?.conversation_id || getMainConversationId();
 
   // Create child conversation ID with parent reference
   const conversationId = useRef(
-    `child_${flight.itineraries[0].segments[0].departure.iataCode}-` +
-    `${flight.itineraries[0].segments[0].arrival.iataCode}_` +
-    `${new Date(flight.itineraries[0].segments[0].departure.at).toISOString().split('T')[0]}_` +
-    `${flight.itineraries[0].segments[0].carrierCode}${flight.itineraries[0].segments[0].number}`
+    `child_${parentConversationId}_${flight.origin}-${flight.destination}_` +
+    `${flight.departure.split('T')[0]}_${flight.flight_number}`
   );
 
+  // The full offer (terminals, fare details) is loaded when the sheet opens
+  const openSheet = async () => {
+    setIsOpen(true);
+    if (!details) {
+      setDetails(await fetchResultDetails(parentConversationId, 'flight-results', flight.id));
+    }
+  };
+
   const handleSheetSend = async () => {
     if (!sheetMessage.trim()) return;
     
@@ -113,17 +251,11 @@ const FlightCard = ({ flight, messages, setMessages, saveToSupabase }: { flight:
       parent_conversation_id: parentConversationId
     } as MessageType;
 
-    // Get only relevant messages for this conversation
-    const relevantMessages = messages.filter(msg => msg.conversation_id === conversationId.current);
-
     // Send message to backend with context including both flight and hotel details
-    socket.emit('chat_message', {
-      messages: [...relevantMessages, newMessage],
-      context: {
-        flightDetails: flight || null,
-        conversation_id: conversationId.current,
-        parent_conversation_id: parentConversationId
-      }
+    sendChatMessage(newMessage, {
+      flightDetails: details || flight,
+      conversation_id: conversationId.current,
+      parent_conversation_id: parentConversationId
     });
 
     setMessages((prev: MessageType[]) => [...prev, newMessage]);
@@ -136,19 +268,19 @@ const FlightCard = ({ flight, messages, setMessages, saveToSupabase }: { flight:
     <>
       <div 
         className="bg-white rounded-lg shadow-md p-4 mb-4 cursor-pointer hover:shadow-lg transition-shadow"
-        onClick={() => setIsOpen(true)}
+        onClick={openSheet}
       >
         <div className="flex justify-between items-center mb-2">
           <h3 className="text-lg font-semibold text-blue-600">
-            {flight.itineraries[0].segments[0].departure.iataCode} → {flight.itineraries[0].segments[0].arrival.iataCode}
+            {flight.origin} → {flight.destination}
           </h3>
-          <span className="text-xl font-bold text-blue-600">${flight.price.total}</span>
+          <span className="text-xl font-bold text-blue-600">${flight.price.toFixed(2)}</span>
         </div>
         <div className="text-sm text-gray-600">
-          <p>Departure: {new Date(flight.itineraries[0].segments[0].departure.at).toLocaleString()}</p>
-          <p>Arrival: {new Date(flight.itineraries[0].segments[0].arrival.at).toLocaleString()}</p>
-          <p>Airline: {flight.itineraries[0].segments[0].carrierCode} {flight.itineraries[0].segments[0].number}</p>
-          <p>Duration: {flight.itineraries[0].duration}</p>
+          <p>Departure: {new Date(flight.departure).toLocaleString()}</p>
+          <p>Arrival: {new Date(flight.arrival).toLocaleString()}</p>
+          <p>Airline: {flight.flight_number}</p>
+          <p>Duration: {formatDuration(flight.duration)}{flight.stops > 0 ? `, ${flight.stops} stop(s)` : ''}</p>
         </div>
       </div>
 
@@ -161,30 +293,32 @@ const FlightCard = ({ flight, messages, setMessages, saveToSupabase }: { flight:
                 <div className="space-y-4 mt-4 text-gray-600">
                   <div>
                     <h3 className="text-lg font-semibold">Route</h3>
-                    <p>{flight.itineraries[0].segments[0].departure.iataCode} → {flight.itineraries[0].segments[0].arrival.iataCode}</p>
+                    <p>{flight.origin} → {flight.destination}</p>
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Times</h3>
-                    <p>Departure: {new Date(flight.itineraries[0].segments[0].departure.at).toLocaleString()}</p>
-                    <p>Arrival: {new Date(flight.itineraries[0].segments[0].arrival.at).toLocaleString()}</p>
-                    <p>Duration: {flight.itineraries[0].duration}</p>
+                    <p>Departure: {new Date(flight.departure).toLocaleString()}</p>
+                    <p>Arrival: {new Date(flight.arrival).toLocaleString()}</p>
+                    <p>Duration: {formatDuration(flight.duration)}</p>
+                    <p>Stops: {flight.stops}</p>
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Airline</h3>
-                    <p>Carrier: {flight.itineraries[0].segments[0].carrierCode}</p>
-                    <p>Flight: {flight.itineraries[0].segments[0].carrierCode} {flight.itineraries[0].segments[0].number}</p>
+                    <p>Carrier: {flight.carrier}</p>
+                    <p>Flight: {flight.flight_number}</p>
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Price</h3>
-                    <p className="text-xl font-bold text-blue-600">${flight.price.total}</p>
+                    <p className="text-xl font-bold text-blue-600">${flight.price.toFixed(2)}</p>
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Additional Details</h3>
-                    {flight.itineraries[0].segments[0].departure.terminal && (
-                      <p>Departure Terminal: {flight.itineraries[0].segments[0].departure.terminal}</p>
+                    {!details && <p>Loading details...</p>}
+                    {details?.itineraries[0].segments[0].departure.terminal && (
+                      <p>Departure Terminal: {details.itineraries[0].segments[0].departure.terminal}</p>
                     )}
-                    {flight.itineraries[0].segments[0].arrival.terminal && (
-                      <p>Arrival Terminal: {flight.itineraries[0].segments[0].arrival.terminal}</p>
+                    {details?.itineraries[0].segments[0].arrival.terminal && (
+                      <p>Arrival Terminal: {details.itineraries[0].segments[0].arrival.terminal}</p>
                     )}
                   </div>
                 </div>
@@ -246,7 +380,7 @@ const FlightCard = ({ flight, messages, setMessages, saveToSupabase }: { flight:
 
 // Add HotelCard component
 const HotelCard = ({ hotel, messages, setMessages, saveToSupabase }: { 
-  hotel: HotelData, 
+  hotel: HotelSummary, 
   messages: MessageType[], 
   setMessages: (messages: any) => void, 
   saveToSupabase: (message: string, from: 'user' | 'ai', type: string|null, data: any|null, conversation_id?: string) => void  
@@ -257,11 +391,11 @@ const HotelCard = ({ hotel, messages, setMessages, saveToSupabase }: {
   // Get the parent conversation ID from the most recent hotel search message
   const parentConversationId = messages
     .filter(msg => msg.type === 'hotel-results')
-    .pop()?.conversation_id || 'main_chat';
+    .pop()?.conversation_id || getMainConversationId();
 
   // Create child conversation ID with parent reference
   const conversationId = useRef(
-    `child_hotel_${hotel.hotelId}_${hotel.iataCode}`
+    `child_${parentConversationId}_hotel_${hotel.id}_${hotel.city}`
   );
 
 
@@ -275,17 +409,11 @@ const HotelCard = ({ hotel, messages, setMessages, saveToSupabase }: {
       parent_conversation_id: parentConversationId
     } as MessageType;
 
-    // Get only relevant messages for this conversation
-    const relevantMessages = messages.filter(msg => msg.conversation_id === conversationId.current);
-
     // Send message to backend with context including hotel details
-    socket.emit('chat_message', {
-      messages: [...relevantMessages, newMessage],
-      context: {
-        hotelDetails: hotel,
-        conversation_id: conversationId.current,
-        parent_conversation_id: parentConversationId
-      }
+    sendChatMessage(newMessage, {
+      hotelDetails: hotel,
+      conversation_id: conversationId.current,
+      parent_conversation_id: parentConversationId
     });
 
     setMessages((prev: MessageType[]) => [...prev, newMessage]);
@@ -306,8 +434,8 @@ const HotelCard = ({ hotel, messages, setMessages, saveToSupabase }: {
           </h3>
         </div>
         <div className="text-sm text-gray-600">
-          <p>Location: {hotel.iataCode}</p>
-          <p>Chain: {hotel.chainCode}</p>
+          <p>Location: {hotel.city}{hotel.distance !== null ? `, ${hotel.distance} km from the centre` : ''}</p>
+          <p>Chain: {hotel.chain}</p>
         </div>
       </div>
 
@@ -324,16 +452,16 @@ const HotelCard = ({ hotel, messages, setMessages, saveToSupabase }: {
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Location</h3>
-                    <p>Airport Code: {hotel.iataCode}</p>
-                    <p>Coordinates: {hotel.geoCode.latitude}, {hotel.geoCode.longitude}</p>
+                    <p>Airport Code: {hotel.city}</p>
+                    <p>Coordinates: {hotel.latitude}, {hotel.longitude}</p>
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Chain</h3>
-                    <p>{hotel.chainCode}</p>
+                    <p>{hotel.chain}</p>
                   </div>
                   <div>
                     <h3 className="text-lg font-semibold">Country</h3>
-                    <p>{hotel.address?.countryCode || 'Not specified'}</p>
+                    <p>{hotel.country || 'Not specified'}</p>
                   </div>
                 </div>
               </SheetHeader>
@@ -398,7 +526,8 @@ export default function Home() {
     {message: "Hello! How can I help you today?", from: 'ai'}
   ]);
   const messagesEndRef = useRef<HTMLDivElement>(null);
-  const mainConversationId = useRef('main_chat');
+  const messagesRef = useRef<MessageType[]>(messages);
+  const mainConversationId = useRef(getMainConversationId());
 
   // Add this new state
   const [stepByStep, setStepByStep] = useState<StepByStepState>({
@@ -412,6 +541,7 @@ export default function Home() {
 
   useEffect(() => {
     scrollToBottom();
+    messagesRef.current = messages;
   }, [messages]);
 
   useEffect(() => {
@@ -428,13 +558,49 @@ export default function Home() {
       console.error('Socket error:', error);
     });
 
+    // The server lost track of this conversation, send the full history once
+    socket.on('resync_required', (request: any) => {
+      const conversationId = request.conversation_id;
+      const history = messagesRef.current
+        .filter(msg => msg.conversation_id === conversationId)
+        .map(({ data, ...msg }) => msg);
+      const seq = history.filter(msg => msg.from === 'user').length;
+      sequenceNumbers.set(conversationId, seq);
+
+      emitChatMessage({
+        conversation_id: conversationId,
+        seq,
+        resync: true,
+        messages: history,
+        context: lastContexts.get(conversationId) || { conversation_id: conversationId }
+      });
+    });
+
     socket.on('chat_response', (response: any) => {
+      // Streamed messages arrive as start/delta chunks, the end chunk carries the full message
+      if (response?.stream === 'start') {
+        setMessages(prev => [...prev, {message: '', from: 'ai', type: response.type, conversation_id: response.conversation_id, message_id: response.message_id}]);
+        return;
+      }
+      if (response?.stream === 'delta') {
+        setMessages(prev => prev.map(msg => msg.message_id === response.message_id ? {...msg, message: msg.message + response.delta} : msg));
+        return;
+      }
+
       console.log('Received response:', response);
       if (!response || !response.message) {
         console.error('Invalid response format:', response);
         return;
       }
 
+      // Shed turn, shown but not saved, the message goes out again after retry_after
+      if (response.status === 'busy') {
+        retryChatMessage(response);
+        const reason = response.reason === 'rate_limited' ? 'You are sending messages too quickly' : 'The assistant is busy';
+        setMessages(prev => [...prev, {message: `${reason}, sending your message again in ${response.retry_after}s.`, from: 'ai', conversation_id: response.conversation_id}]);
+        return;
+      }
+
       // Add step-by-step handling
       if (response.type === 'step_by_step_response') {
         setStepByStep({
@@ -445,13 +611,37 @@ export default function Home() {
 
       // Add AI response to messages and save to Supabase
       const aiMessage = response.message;
-      const aiData = response.data as FlightData[];
+      const aiData = response.data as (FlightSummary | HotelSummary)[];
       const aiType = response.type;
       const aiConversationId = response.conversation_id;
-      setMessages(prev => [...prev, {message: aiMessage, from: 'ai', type: aiType, data: aiData, conversation_id: aiConversationId}]);
+      if (response.stream === 'end') {
+        setMessages(prev => prev.map(msg => msg.message_id === response.message_id ? {...msg, message: aiMessage} : msg));
+      } else {
+        setMessages(prev => [...prev, {message: aiMessage, from: 'ai', type: aiType, data: aiData, conversation_id: aiConversationId, page: response.page, has_more: response.has_more}]);
+      }
       saveToSupabase(aiMessage, 'ai', aiType, aiData, aiConversationId);
     });
 
+    // Further pages are appended to the latest results message of their type
+    socket.on('results_page', (response: any) => {
+      if (response.status !== 'success') {
+        console.error('Results page failed:', response.message);
+        return;
+      }
+      setMessages(prev => {
+        const index = prev.map(msg => msg.type === response.type && msg.conversation_id === response.conversation_id).lastIndexOf(true);
+        if (index === -1) return prev;
+        const updated = [...prev];
+        updated[index] = {
+          ...prev[index],
+          data: [...(prev[index].data || []), ...response.data],
+          page: response.page,
+          has_more: response.has_more
+        };
+        return updated;
+      });
+    });
+
     // Fetch existing messages from Supabase
     fetchMessages();
 
@@ -460,6 +650,8 @@ export default function Home() {
       socket.off('connect');
       socket.off('disconnect');
       socket.off('error');
+      socket.off('resync_required');
+      socket.off('results_page');
       // socket.off('chat_response');
       socket.disconnect();
     };
@@ -498,6 +690,14 @@ export default function Home() {
     }
   };
 
+  const loadMoreResults = (msg: MessageType) => {
+    socket.emit('results_page', {
+      conversation_id: msg.conversation_id,
+      type: msg.type,
+      page: (msg.page || 0) + 1
+    });
+  };
+
   const handleSend = async () => {
     if (!message.trim()) return;
     
@@ -508,11 +708,8 @@ export default function Home() {
     };
 
     // Send message to backend
-    socket.emit('chat_message', {
-      messages: [...messages, newMessage],
-      context: {
-        conversation_id: mainConversationId.current
-      }
+    sendChatMessage(newMessage, {
+      conversation_id: mainConversationId.current
     });
 
     setMessages(prev => [...prev, newMessage]);
@@ -574,13 +771,21 @@ export default function Home() {
                 >
                   {msg.data && Array.isArray(msg.data) && (msg.type === 'flight-results' || msg.type === 'hotel-results') ? (
                     <div className="space-y-2">
-                      {msg.data.slice(0, 10).map((item: FlightData | HotelData, idx: number) => (
-                        'type' in item ? (
-                          <FlightCard key={idx} flight={item as FlightData} messages={messages} setMessages={setMessages} saveToSupabase={saveToSupabase} />
+                      {msg.data.map((item: any, idx: number) => (
+                        msg.type === 'flight-results' ? (
+                          <FlightCard key={idx} flight={toFlightSummary(item)} messages={messages} setMessages={setMessages} saveToSupabase={saveToSupabase} />
                         ) : (
-                          <HotelCard key={idx} hotel={item as HotelData} messages={messages} setMessages={setMessages} saveToSupabase={saveToSupabase} />
+                          <HotelCard key={idx} hotel={toHotelSummary(item)} messages={messages} setMessages={setMessages} saveToSupabase={saveToSupabase} />
                         )
                       ))}
+                      {msg.has_more && (
+                        <button
+                          onClick={() => loadMoreResults(msg)}
+                          className="bg-white text-blue-600 px-4 py-2 rounded-lg hover:bg-gray-100 transition-colors"
+                        >
+                          Show more
+                        </button>
+                      )}
                     </div>
                   ) : (
                     <p>{msg.message}</p>
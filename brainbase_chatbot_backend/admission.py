@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+
+
+# Turn priorities, lower is served first: bookings in progress in a sheet,
+# then further turns of a known conversation, then new conversations
+BOOKING, FOLLOW_UP, NEW = 0, 1, 2
+PRIORITY_NAMES = {BOOKING: 'booking', FOLLOW_UP: 'follow_up', NEW: 'new'}
+
+
+class AdmissionRejected(Exception):
+    """A chat turn was shed, the client may retry after retry_after seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Turn rejected ({reason}), retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows `rate` turns per second on average and bursts of up to `burst`"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    Token buckets by key (a sid or a conversation id). Buckets are kept for
+    the max_keys most recently seen keys, a bucket that is dropped comes back
+    full, which only ever lets an idle key through.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionController:
+    """
+    Bounds the chat turns the process works on. At most max_in_flight turns
+    run at once; further turns wait in a queue of max_queue, served by
+    priority and then in arrival order, and give up after queue_timeout
+    seconds. When the queue is full a turn takes the place of the newest
+    waiting turn of a lower priority, or is rejected.
+
+    Separately, check_rate_limits() takes a token of the rate limit of the
+    sid and of the conversation when a turn arrives. Every rejection is an
+    AdmissionRejected carrying how long the client should wait, estimated
+    from the recent turn durations and the length of the queue.
+    """
+
+    def __init__(self, max_in_flight=32, max_queue=64, queue_timeout=10.0,
+                 sid_limiter=None, conversation_limiter=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.sid_limiter = sid_limiter if sid_limiter is not None else RateLimiter(0, 0)
+        self.conversation_limiter = conversation_limiter if conversation_limiter is not None else RateLimiter(0, 0)
+
+        self.in_flight = 0
+        self.queued = 0
+        self._queue = []
+        self._arrivals = itertools.count()
+        # Moving average of the turn duration, for retry_after estimates
+        self.turn_seconds = 2.0
+
+        self.admitted = 0
+        self.rejected = {'rate_limited': 0, 'overloaded': 0, 'queue_timeout': 0}
+
+    async def acquire(self, priority):
+        """
+        Wait for a turn slot. Returns the admission time to pass to release(),
+        raises AdmissionRejected when the turn is shed.
+        """
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return time.monotonic()
+
+        if self.queued >= self.max_queue and not self._evict(priority):
+            raise self._reject('overloaded')
+
+        # Slots are handed over by release(), the future gets the admission time
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._arrivals), future))
+        self.queued += 1
+        try:
+            admitted_at = await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.queued -= 1
+            raise self._reject('queue_timeout')
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.queued -= 1
+            elif future.exception() is None:
+                # The slot was handed over just as the turn was cancelled
+                self.release(future.result())
+            raise
+
+        self.admitted += 1
+        return admitted_at
+
+    def release(self, admitted_at):
+        """Give the slot of a finished turn to the next waiting turn"""
+        now = time.monotonic()
+        self.turn_seconds += 0.1 * (now - admitted_at - self.turn_seconds)
+
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            # Timed out, cancelled and evicted turns stay in the heap until they come up
+            if not future.done():
+                self.queued -= 1
+                future.set_result(now)
+                return
+        self.in_flight -= 1
+
+    def forget(self, sid):
+        """Drop the rate limit state of a disconnected client"""
+        self.sid_limiter.forget(sid)
+
+    def retry_after(self):
+        """Whole seconds until a slot is likely to be free"""
+        backlog = (self.queued + 1) / max(self.max_in_flight, 1)
+        return max(1, math.ceil(self.turn_seconds * backlog))
+
+    def check_rate_limits(self, sid, conversation_id):
+        """Take a token for a new turn, raises AdmissionRejected when a limit is exhausted"""
+        now = time.monotonic()
+        buckets = [
+            limiter.bucket(key, now)
+            for limiter, key in ((self.sid_limiter, sid), (self.conversation_limiter, conversation_id))
+            if limiter.enabled
+        ]
+        wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+        if wait > 0:
+            self.rejected['rate_limited'] += 1
+            raise AdmissionRejected('rate_limited', max(1, math.ceil(wait)))
+        # Tokens are only taken once every limit allows the turn
+        for bucket in buckets:
+            bucket.take()
+
+    def _evict(self, priority):
+        """Shed the newest waiting turn of a lower priority than `priority`, if there is one"""
+        waiting = [entry for entry in self._queue if not entry[2].done()]
+        if not waiting:
+            return False
+        worst = max(waiting, key=lambda entry: (entry[0], entry[1]))
+        if worst[0] <= priority:
+            return False
+        self.queued -= 1
+        worst[2].set_exception(self._reject('overloaded'))
+        return True
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return AdmissionRejected(reason, self.retry_after())
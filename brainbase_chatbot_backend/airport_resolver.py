@@ -0,0 +1,150 @@
+import asyncio
+import difflib
+import json
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+
+
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'airports.json')
+
+_IATA_CODE = re.compile(r'[A-Z]{3}')
+
+
+def normalize_city(name):
+    """
+    Normalize a city name for lookups: strip accents, lowercase,
+    drop punctuation and collapse whitespace. "São Paulo " -> "sao paulo"
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r'[^a-z0-9]+', ' ', name.lower())
+    return name.strip()
+
+
+class AirportResolver:
+    """
+    Resolves city names to IATA codes without a network call for known cities.
+    Lookups go through an in-memory LRU, then the on-disk table of city names
+    and aliases (exact match on the normalized name, then a fuzzy match for
+    misspellings). The shipped table is only read. Codes learned from the
+    remote fallback go to a separate overlay file, if learned_path is set, and
+    are merged over the table at load so they resolve locally after a restart.
+    """
+
+    def __init__(self, table_path=DEFAULT_TABLE_PATH, learned_path=None, lru_size=1024, fuzzy_cutoff=0.85):
+        self.table_path = table_path
+        self.learned_path = learned_path
+        self.lru_size = lru_size
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._lru = OrderedDict()
+        self._learned = []
+        self._index = {}
+        self._save_lock = asyncio.Lock()
+        self.load()
+
+    def load(self):
+        self._index = {}
+        for record in _read_records(self.table_path):
+            self._index_record(record)
+
+        # Learned names come last, so they win over the shipped table
+        self._learned = [record for record in _read_records(self.learned_path) if is_iata_code(record.get('iata'))]
+        for record in self._learned:
+            self._index_record(record)
+
+        print(f"Loaded {len(self._index)} city names into the airport index ({len(self._learned)} learned)")
+
+    def _index_record(self, record):
+        for name in [record['city'], *record.get('aliases', [])]:
+            key = normalize_city(name)
+            if key:
+                self._index[key] = record['iata']
+
+    def lookup(self, city_name):
+        """Return the IATA code for a city name, or None if it is not known locally"""
+        code = self._lru.get(city_name)
+        if code is not None:
+            self._lru.move_to_end(city_name)
+            return code
+
+        code = self._match(city_name)
+        if code is not None:
+            self._remember_in_lru(city_name, code)
+        return code
+
+    def _match(self, city_name):
+        normalized = normalize_city(city_name)
+        # "New York, NY" should also try "New York"
+        candidates = [normalized]
+        if ',' in city_name:
+            candidates.append(normalize_city(city_name.split(',')[0]))
+
+        for candidate in candidates:
+            if candidate in self._index:
+                return self._index[candidate]
+
+        for candidate in candidates:
+            # Very short strings match too many names to be trusted
+            if len(candidate) < 4:
+                continue
+            matches = difflib.get_close_matches(candidate, self._index.keys(), n=1, cutoff=self.fuzzy_cutoff)
+            if matches:
+                return self._index[matches[0]]
+
+        return None
+
+    def _remember_in_lru(self, city_name, code):
+        self._lru[city_name] = code
+        self._lru.move_to_end(city_name)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    async def remember(self, city_name, code):
+        """Add a code resolved by the remote lookup to the learned names and persist them"""
+        if not is_iata_code(code):
+            print(f"Not remembering {code!r} for {city_name!r}, it is not an IATA code")
+            return
+        self._remember_in_lru(city_name, code)
+
+        key = normalize_city(city_name)
+        if not key or self._index.get(key) == code:
+            return
+
+        for record in self._learned:
+            if record['iata'] == code:
+                record.setdefault('aliases', []).append(city_name)
+                break
+        else:
+            self._learned.append({'iata': code, 'city': city_name, 'aliases': []})
+        self._index[key] = code
+
+        if self.learned_path:
+            await self._save()
+
+    async def _save(self):
+        async with self._save_lock:
+            content = json.dumps(self._learned, indent=2, ensure_ascii=False)
+            await asyncio.to_thread(self._write, content)
+
+    def _write(self, content):
+        directory = os.path.dirname(self.learned_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.learned_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, self.learned_path)
+
+
+def is_iata_code(code):
+    """Whether code looks like an IATA city or airport code: three uppercase letters"""
+    return isinstance(code, str) and _IATA_CODE.fullmatch(code) is not None
+
+
+def _read_records(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
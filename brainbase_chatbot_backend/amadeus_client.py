@@ -0,0 +1,198 @@
+import asyncio
+import time
+import aiohttp
+from resilience import RetryBudget, Upstream
+from single_flight import SingleFlight
+
+
+DEFAULT_BASE_URL = "https://test.api.amadeus.com"
+
+# Total timeout in seconds for each Amadeus endpoint
+DEFAULT_TIMEOUTS = {
+    'token': 10,
+    'locations': 10,
+    'flight_offers': 30,
+    'hotels_by_city': 20,
+}
+
+
+class AmadeusServerError(Exception):
+    """A 429 or 5xx answer, worth retrying"""
+
+    def __init__(self, status):
+        super().__init__(f"Amadeus returned HTTP {status}")
+        self.status = status
+
+
+def is_retryable(error):
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError, AmadeusServerError))
+
+
+class TokenManager:
+    """
+    Caches the Amadeus OAuth token until shortly before it expires.
+    Once the token is close to expiry a refresh is started in the background
+    while callers keep using the current one, and concurrent callers share a
+    single in-flight refresh instead of each hitting the token endpoint.
+    """
+
+    def __init__(self, client, expiry_margin=60, refresh_ahead=300):
+        self.client = client
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self._token = None
+        self._expires_at = 0
+        self._refresh_task = None
+
+    async def get_token(self):
+        now = time.monotonic()
+
+        if self._token and now < self._expires_at - self.expiry_margin:
+            if now >= self._expires_at - self.refresh_ahead:
+                self._start_refresh()
+            return self._token
+
+        # Shield the shared refresh so one cancelled caller doesn't cancel it for the others
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self):
+        self._token = None
+        self._expires_at = 0
+
+    def _start_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+            self._refresh_task.add_done_callback(self._log_refresh_failure)
+        return self._refresh_task
+
+    async def _refresh(self):
+        response = await self.client.fetch_token()
+
+        self._token = response['access_token']
+        self._expires_at = time.monotonic() + int(response.get('expires_in', 1799))
+
+        return self._token
+
+    def _log_refresh_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Amadeus token refresh failed: {task.exception()}")
+
+
+class AmadeusClient:
+    """
+    Shared Amadeus client backed by one aiohttp session.
+    The session keeps connections alive between calls and caches DNS lookups,
+    so a search no longer pays a fresh TCP/TLS handshake per request.
+    Every endpoint has its own timeout, retries of transient failures and
+    circuit breaker; the retry budget is shared by all of them.
+    The base URL can point at a local stub instead of the Amadeus test API,
+    with a cassette the calls are recorded, or replayed without Amadeus.
+    """
+
+    def __init__(self, client_id, client_secret, base_url=DEFAULT_BASE_URL,
+                 timeouts=None, pool_size=100, dns_ttl=300, max_retries=2, cassette=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.pool_size = pool_size
+        self.dns_ttl = dns_ttl
+        self.cassette = cassette
+        self._session = None
+        self.tokens = TokenManager(self)
+        self.single_flight = SingleFlight()
+        budget = RetryBudget()
+        self.upstreams = {
+            endpoint: Upstream(f"Amadeus {endpoint}", max_retries=max_retries, budget=budget, is_retryable=is_retryable)
+            for endpoint in self.timeouts
+        }
+
+    def _get_session(self):
+        # The session has to be created inside the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=30
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(self, method, path, endpoint, params=None, data=None, headers=None):
+        """
+        Send a request to Amadeus and return the decoded JSON body.
+        Raises UpstreamError once the endpoint's retries are used up and
+        CircuitOpenError while the endpoint's circuit is open.
+        """
+        timeout = aiohttp.ClientTimeout(total=self.timeouts[endpoint])
+
+        async def send():
+            session = self._get_session()
+            async with session.request(method, f"{self.base_url}{path}", params=params, data=data,
+                                       headers=headers, timeout=timeout) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise AmadeusServerError(response.status)
+                if response.status == 401 and endpoint != 'token':
+                    # Token was revoked or expired early, fetch a fresh one next time
+                    self.tokens.invalidate()
+                return await response.json(content_type=None)
+
+        if self.cassette is not None:
+            # Credentials and tokens are not part of the recorded request
+            request = {'method': method, 'path': path, 'params': params}
+            return await self.cassette.exchange(
+                self.upstreams[endpoint].name, request, lambda: self.upstreams[endpoint].call(send)
+            )
+        return await self.upstreams[endpoint].call(send)
+
+    async def fetch_token(self):
+        """Request a new OAuth token, returns the raw token response"""
+        payload = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+
+        return await self.request("POST", "/v1/security/oauth2/token", 'token', data=payload)
+
+    async def get(self, path, endpoint, access_token, params=None):
+        """
+        GET an Amadeus endpoint. Identical concurrent requests, e.g. many
+        conversations searching the same city, share one upstream call.
+        """
+        headers = {
+            'Authorization': f'Bearer {access_token}'
+        }
+        key = (path, tuple(sorted((params or {}).items())))
+
+        return await self.single_flight.do(
+            key, lambda: self.request("GET", path, endpoint, params=params, headers=headers)
+        )
+
+    async def search_locations(self, keyword, access_token, sub_type="CITY"):
+        params = {'subType': sub_type, 'keyword': keyword}
+
+        return await self.get("/v1/reference-data/locations", 'locations', access_token, params)
+
+    async def search_flight_offers(self, origin, destination, date, access_token,
+                                   adults=1, non_stop=True, currency="USD"):
+        params = {
+            'originLocationCode': origin,
+            'destinationLocationCode': destination,
+            'departureDate': date,
+            'adults': str(adults),
+            'nonStop': 'true' if non_stop else 'false',
+            'currencyCode': currency
+        }
+
+        return await self.get("/v2/shopping/flight-offers", 'flight_offers', access_token, params)
+
+    async def search_hotels_by_city(self, city_code, access_token):
+        params = {'cityCode': city_code.upper()}
+
+        return await self.get("/v1/reference-data/locations/hotels/by-city", 'hotels_by_city', access_token, params)
@@ -1,10 +1,34 @@
 from aiohttp import web
 import socketio
-from openai import OpenAI
+from llm_gateway import LLMGateway, build_messages
+from amadeus_client import AmadeusClient, DEFAULT_BASE_URL
+from airport_resolver import AirportResolver, DEFAULT_TABLE_PATH, is_iata_code
+from intent_classifier import IntentClassifier, DEFAULT_MODEL_PATH, DEFAULT_THRESHOLD
+from response_cache import ResponseCache, normalize_question, response_key
+from context_window import ContextWindowManager
+from search_cache import SearchCache, flight_offer_key
+from conversation_store import ConversationStore
+from task_scheduler import TaskScheduler, TaskSpec, emit_in_task_order, provide_inputs
+from trip_extraction import (
+    REQUIRED_SLOTS, SLOT_FIELDS, TRIP_REQUEST_FORMAT, TripRequest,
+    build_extraction_messages, build_slot_messages, missing_question, parse_slot_answer,
+    parse_trip_request, render_plan, slot_answer_format
+)
+from slot_filling import TripSlots, next_occurrence
+from result_shaping import DEFAULT_PAGE_SIZE, departure_preference, shape_results
+from results_store import ResultsStore
+from metrics import EVENT_LOOP_LAG, REGISTRY, monitor_event_loop
+from model_output import ModelOutputError
+from resilience import CircuitOpenError, UpstreamError
+from cassette import Cassette, use_conversation
+from conversation_executor import ConversationExecutor
+from admission import BOOKING, FOLLOW_UP, NEW, PRIORITY_NAMES, AdmissionController, AdmissionRejected, RateLimiter
 import os
+import json
 from dotenv import load_dotenv
-import requests
 import asyncio
+import time
+import uuid
 from datetime import datetime
 
 # Load environment variables
@@ -15,38 +39,356 @@ sio = socketio.AsyncServer(cors_allowed_origins='*')
 app = web.Application()
 sio.attach(app)
 
-# Initialize OpenAI client
+# Record or replay the OpenAI and Amadeus traffic of each conversation, for offline profiling runs
+cassette = None
+if os.getenv('CASSETTE_MODE'):
+    cassette = Cassette(
+        os.getenv('CASSETTE_DIR', 'cassettes'),
+        mode=os.getenv('CASSETTE_MODE'),
+        latency_scale=float(os.getenv('CASSETTE_LATENCY_SCALE', 0))
+    )
+    if cassette.replaying:
+        cassette.load_all()
+    print(f"Cassette {cassette.mode} mode, directory {cassette.directory}")
+
+async def save_cassette(app):
+    if cassette is not None:
+        cassette.save()
+
+app.on_cleanup.append(save_cassette)
+
+# Initialize the LLM gateway, every OpenAI call goes through it
 print("OPENAI_API_KEY: ", os.getenv('OPENAI_API_KEY'))
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+llm = LLMGateway(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 8)),
+    timeout=float(os.getenv('LLM_TIMEOUT', 60)),
+    max_retries=int(os.getenv('LLM_MAX_RETRIES', 2)),
+    cassette=cassette
+)
+
+# Categories and trip details come from one structured-output call, which needs a model with JSON schema support
+EXTRACTION_MODEL = os.getenv('LLM_EXTRACTION_MODEL', 'gpt-4o-2024-08-06')
+
+# Stream LLM-generated messages to the client token by token
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') != '0'
+
+# Flight and hotel results are sent as ranked summaries, one page at a time
+RESULTS_PAGE_SIZE = int(os.getenv('RESULTS_PAGE_SIZE', DEFAULT_PAGE_SIZE))
+RESULT_TASKS = {'flight-results': 'flights', 'hotel-results': 'hotels'}
+
+# Full offers of every search are kept on disk, conversations only hold the ranked summaries
+results_store = ResultsStore(os.getenv('RESULTS_DB_PATH') or None)
+
+async def close_results_store(app):
+    results_store.close()
+
+app.on_cleanup.append(close_results_store)
 
 # Get Amadeus credentials
 amadeus_client_id = os.getenv('AMADEUS_CLIENT_ID')
 amadeus_client_secret = os.getenv('AMADEUS_CLIENT_SECRET')
 
-conversation_history = []
-task_metadata = {}
+# Shared Amadeus client, AMADEUS_BASE_URL can point at a local stub
+amadeus = AmadeusClient(
+    amadeus_client_id,
+    amadeus_client_secret,
+    base_url=os.getenv('AMADEUS_BASE_URL', DEFAULT_BASE_URL),
+    max_retries=int(os.getenv('AMADEUS_MAX_RETRIES', 2)),
+    cassette=cassette
+)
+
+async def close_amadeus(app):
+    await amadeus.close()
+
+app.on_cleanup.append(close_amadeus)
+
+# Local city -> IATA index, loaded once at startup
+airport_resolver = AirportResolver(
+    os.getenv('AIRPORT_TABLE_PATH', DEFAULT_TABLE_PATH),
+    learned_path=os.getenv('AIRPORT_LEARNED_PATH') or None
+)
+
+# Local classifier answering confident new requests without the extraction call
+intent_classifier = IntentClassifier(
+    os.getenv('INTENT_MODEL_PATH', DEFAULT_MODEL_PATH),
+    threshold=float(os.getenv('INTENT_CONFIDENCE_THRESHOLD', DEFAULT_THRESHOLD))
+)
+
+# Flight offers shared across conversations, served stale while a refresh runs
+flight_offer_cache = SearchCache(
+    ttl=int(os.getenv('FLIGHT_CACHE_TTL', 300)),
+    stale_ttl=int(os.getenv('FLIGHT_CACHE_STALE_TTL', 900)),
+    max_bytes=int(os.getenv('FLIGHT_CACHE_MAX_MB', 32)) * 1024 * 1024,
+    should_cache=lambda flight_data: isinstance(flight_data, dict) and 'data' in flight_data
+)
+
+# Generic and follow-up answers, keyed by the normalized question; RESPONSE_CACHE=0 bypasses it
+response_cache = ResponseCache(
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 24 * 3600)),
+    max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 10000)),
+    path=os.getenv('RESPONSE_CACHE_PATH') or None,
+    enabled=os.getenv('RESPONSE_CACHE', '1') != '0'
+)
+
+async def save_response_cache(app):
+    await asyncio.to_thread(response_cache.save)
+
+app.on_cleanup.append(save_response_cache)
+
+# Per-conversation task state, bounded by idle TTL, count and memory
+conversation_store = ConversationStore(
+    idle_ttl=int(os.getenv('CONVERSATION_IDLE_TTL', 3600)),
+    max_conversations=int(os.getenv('MAX_CONVERSATIONS', 10000)),
+    max_bytes=int(os.getenv('CONVERSATION_STORE_MAX_MB', 128)) * 1024 * 1024
+)
+
+# Conversation text sent with the extraction prompt, kept within a token budget
+context_window_manager = ContextWindowManager(
+    budgets={'extraction': int(os.getenv('EXTRACTION_CONTEXT_TOKENS', 1500))}
+)
+
+# Category tasks run as a dependency graph: hotels only need a destination and a date,
+# so they start as soon as the flight search has worked those out
+task_scheduler = TaskScheduler([
+    TaskSpec('flights', provides=('origin', 'destination', 'date')),
+    TaskSpec('hotels', needs=('destination', 'date')),
+    TaskSpec('transports', after=('flights', 'hotels')),
+    TaskSpec('experiences', after=('hotels',)),
+])
+
+# Admission control in front of chat_message: a bounded number of turns run at once, the
+# others queue by priority (bookings in progress first) or are told to retry later
+admission = AdmissionController(
+    max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 32)),
+    max_queue=int(os.getenv('ADMISSION_QUEUE_SIZE', 64)),
+    queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 10)),
+    sid_limiter=RateLimiter(
+        rate=float(os.getenv('SID_RATE_LIMIT', 1)),
+        burst=int(os.getenv('SID_RATE_BURST', 5))
+    ),
+    conversation_limiter=RateLimiter(
+        rate=float(os.getenv('CONVERSATION_RATE_LIMIT', 0.5)),
+        burst=int(os.getenv('CONVERSATION_RATE_BURST', 3))
+    )
+)
+
+# Turns of a conversation and of its sheets run one at a time, different conversations in parallel
+conversation_executor = ConversationExecutor()
+
+# Metrics, served in the Prometheus text format on /metrics
+CHAT_TURN_LATENCY = REGISTRY.histogram('chat_turn_seconds', 'End to end latency of chat_message turns', ('kind',))
+EMIT_LATENCY = REGISTRY.histogram('socketio_emit_seconds', 'Latency of Socket.IO emits', ('event',))
+CHAT_ERRORS = REGISTRY.counter('chat_errors_total', 'chat_message turns that ended with an error', ('reason',))
+CONNECTED_CLIENTS = REGISTRY.gauge('socketio_connected_clients', 'Connected Socket.IO clients')
+ADMISSION_WAIT = REGISTRY.histogram('admission_wait_seconds', 'Time admitted chat turns waited for a slot', ('priority',))
+REGISTRY.gauge('chat_turns_in_flight', 'Chat turns being worked on', callback=lambda: admission.in_flight)
+REGISTRY.gauge('chat_turns_queued', 'Chat turns waiting for a slot', callback=lambda: admission.queued)
+REGISTRY.gauge('conversation_turns_waiting', 'Chat turns waiting for an earlier turn of their conversation',
+               callback=conversation_executor.waiting)
+REGISTRY.callback_counter('chat_turn_admissions_total', 'Chat turns by admission result',
+                          lambda: {('admitted',): admission.admitted,
+                                   **{(reason,): count for reason, count in admission.rejected.items()}}, ('result',))
+REGISTRY.gauge('live_conversations', 'Conversations held in the conversation store',
+               callback=lambda: len(conversation_store))
+REGISTRY.gauge('conversation_store_bytes', 'Estimated memory of the conversation store',
+               callback=conversation_store.memory_bytes)
+REGISTRY.gauge('upstream_circuit_open', 'Whether the circuit breaker of an upstream is open', ('upstream',),
+               callback=lambda: {(upstream.name,): int(upstream.breaker.state != 'closed')
+                                 for upstream in (llm.upstream, *amadeus.upstreams.values())})
+REGISTRY.callback_counter('flight_offer_cache_requests_total', 'Flight offer cache lookups by result',
+                          lambda: {('hit',): flight_offer_cache.hits, ('stale',): flight_offer_cache.stale_hits,
+                                   ('miss',): flight_offer_cache.misses}, ('result',))
+REGISTRY.callback_counter('response_cache_requests_total', 'Generic and follow-up answer cache lookups by result',
+                          lambda: {('hit',): response_cache.hits, ('miss',): response_cache.misses}, ('result',))
+REGISTRY.callback_counter('intent_fast_path_total', 'New requests answered by the local intent classifier or not',
+                          lambda: {('hit',): intent_classifier.hits, ('miss',): intent_classifier.misses}, ('result',))
+REGISTRY.callback_counter('amadeus_coalesced_requests_total', 'Amadeus requests that joined an identical in-flight one',
+                          lambda: amadeus.single_flight.coalesced)
+
+async def metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+app.router.add_get('/metrics', metrics)
+
+async def start_event_loop_monitor(app):
+    app['event_loop_monitor'] = asyncio.create_task(monitor_event_loop(EVENT_LOOP_LAG))
+
+async def stop_event_loop_monitor(app):
+    app['event_loop_monitor'].cancel()
+
+app.on_startup.append(start_event_loop_monitor)
+app.on_cleanup.append(stop_event_loop_monitor)
 
 @sio.event
-async def connect(sid, environ):
+async def connect(sid, environ, auth=None):
     print(f"Client connected: {sid}")
+    CONNECTED_CLIENTS.inc()
+
+    # Each conversation is a room, chat_response events are only sent to its members
+    conversation_id = (auth or {}).get('conversation_id')
+    if conversation_id:
+        await sio.enter_room(sid, conversation_id)
 
 @sio.event
 async def disconnect(sid):
     print(f"Client disconnected: {sid}")
+    CONNECTED_CLIENTS.dec()
+    admission.forget(sid)
+
+def stored_results(sid, conversation_id, result_type):
+    """Ranked results of a conversation's last flight or hotel search, only for members of its room"""
+    task_name = RESULT_TASKS.get(result_type)
+    if task_name is None or not conversation_id or conversation_id not in sio.rooms(sid):
+        return None
+
+    state = conversation_store.get(conversation_id)
+    if state is None:
+        return None
+    return conversation_store.get_payload(state.task(task_name).data)
+
+@sio.event
+async def results_page(sid, data):
+    """Send another page of ranked summaries, e.g. when the user asks for more flights"""
+    conversation_id = data.get('conversation_id')
+    result_type = data.get('type')
+    page = data.get('page', 0)
+    if isinstance(page, str) and page.isdigit():
+        page = int(page)
+    if not isinstance(page, int) or isinstance(page, bool) or page < 0:
+        await sio.emit('results_page', {
+            'status': 'error',
+            'message': 'page must be a whole number, starting at 0',
+            'type': result_type,
+            'conversation_id': conversation_id
+        }, to=sid)
+        return
+
+    results = stored_results(sid, conversation_id, result_type)
+    if results is None:
+        await sio.emit('results_page', {
+            'status': 'error',
+            'message': 'These results are no longer available, please search again',
+            'type': result_type,
+            'conversation_id': conversation_id
+        }, to=sid)
+        return
+
+    await sio.emit('results_page', {
+        'status': 'success',
+        **results.page(page, RESULTS_PAGE_SIZE),
+        'type': result_type,
+        'conversation_id': conversation_id
+    }, to=sid)
+
+@sio.event
+async def result_details(sid, data):
+    """Send the full Amadeus offer or hotel behind one summary, when its sheet is opened"""
+    conversation_id = data.get('conversation_id')
+    result_type = data.get('type')
+    results = stored_results(sid, conversation_id, result_type)
+    details = await results.details(str(data.get('id'))) if results else None
+
+    await sio.emit('result_details', {
+        'status': 'success' if details is not None else 'error',
+        'data': details,
+        'id': data.get('id'),
+        'type': result_type,
+        'conversation_id': conversation_id
+    }, to=sid)
+
+def turn_priority(conversation_id):
+    """Admission priority of a chat turn, bookings in progress go first"""
+    if conversation_id.startswith('child_'):
+        return BOOKING
+    return FOLLOW_UP if conversation_id in conversation_store else NEW
+
+
+def busy_response(rejection, conversation_id, seq):
+    """
+    The chat_response for a shed turn. Its messages were not applied, the
+    client can send them again with the same seq after retry_after seconds.
+    """
+    if rejection.reason == 'rate_limited':
+        message = f"You are sending messages too quickly. Please try again in {rejection.retry_after} seconds."
+    else:
+        message = f"The assistant is busy right now. Please try again in {rejection.retry_after} seconds."
+
+    return {
+        'status': 'busy',
+        'message': message,
+        'reason': rejection.reason,
+        'retry_after': rejection.retry_after,
+        'seq': seq,
+        'conversation_id': conversation_id
+    }
+
+
+def conversation_root(conversation_id, data):
+    """The conversation whose turn order a chat_message joins, sheets share their parent's"""
+    if conversation_id.startswith('child_'):
+        return data['messages'][-1].get('parent_conversation_id') or conversation_id
+    return conversation_id
+
 
 @sio.event
 async def chat_message(sid, data):
+    conversation_id = None
+    received_at = time.perf_counter()
     try:
-        global conversation_history, task_metadata
-        conversation_history = data['messages']
-        
-        # Get the latest message's conversation ID
-        conversation_id = conversation_history[-1].get('conversation_id')
+        # Get the conversation ID, older clients only set it on the messages
+        conversation_id = data.get('conversation_id') or data['messages'][-1].get('conversation_id')
+        use_conversation(conversation_id)
+
+        # Rate limits apply on arrival, so a flood never piles up in the conversation's queue
+        admission.check_rate_limits(sid, conversation_id)
+        await conversation_executor.run(
+            conversation_root(conversation_id, data),
+            lambda: run_turn(sid, data, conversation_id, received_at)
+        )
+    except AdmissionRejected as rejection:
+        print(f"Shed turn of {conversation_id}: {rejection}")
+        await sio.emit('chat_response', busy_response(rejection, conversation_id, data.get('seq')), to=sid)
+    except UpstreamError as e:
+        print("Upstream failure in chat_message:", str(e))
+        CHAT_ERRORS.inc(reason='upstream')
+        await sio.emit('chat_response', unavailable_response(e, conversation_id), to=sid)
+    except Exception as e:
+        print("Error in chat_message:", str(e))  # Add explicit error logging
+        CHAT_ERRORS.inc(reason='internal')
+        await sio.emit('chat_response', {
+            'status': 'error',
+            'message': str(e),
+            'conversation_id': conversation_id
+        }, to=sid)
+
+
+async def run_turn(sid, data, conversation_id, received_at):
+    """
+    Process one chat_message once the earlier turns of its conversation are
+    done and it has an admission slot. Everything a turn changes lives in the
+    conversation store, the turn order makes it safe to change across awaits.
+    """
+    priority = turn_priority(conversation_id)
+    queued_at = time.perf_counter()
+    admitted_at = await admission.acquire(priority)
+    ADMISSION_WAIT.observe(time.perf_counter() - queued_at, priority=PRIORITY_NAMES[priority])
+
+    try:
+        state = conversation_store.get_or_create(conversation_id)
+        if not await sync_history(sid, state, data):
+            return
+        conversation_history = state.history
         
         # Check if this is a sheet message (child conversation)
         is_sheet_message = conversation_id.startswith('child_')
         parent_conversation_id = conversation_history[-1].get('parent_conversation_id')
 
+        # Join the conversation rooms on the first message, sheet messages also report to the parent
+        await sio.enter_room(sid, conversation_id)
+        if parent_conversation_id:
+            await sio.enter_room(sid, parent_conversation_id)
+
         if is_sheet_message:
             print(f"Processing sheet message for flight conversation: {conversation_id}")
             # Handle sheet-specific logic here
@@ -55,30 +397,35 @@ async def chat_message(sid, data):
             hotel_context = data.get('context', {}).get('hotelDetails')
             if flight_context:
                 print(f"Flight context available: {flight_context}")
-                follow_up_response_msg = follow_up_response(flight_context, conversation_history[-1]['message'], conversation_id)
+                follow_up_response_msg = await follow_up_response(flight_context, conversation_history[-1]['message'], conversation_id)
 
 
             if hotel_context:
                 print(f"Hotel context available: {hotel_context}")
-                follow_up_response_msg = follow_up_response(hotel_context, conversation_history[-1]['message'], conversation_id)
+                follow_up_response_msg = await follow_up_response(hotel_context, conversation_history[-1]['message'], conversation_id)
                 print("Follow up response msg: ", follow_up_response_msg)
 
             if(follow_up_response_msg != "booking_completed"):
-                await sio.emit('chat_response', {
+                await emit_chat_response(conversation_id, {
                 'status': 'success',
                     'message': follow_up_response_msg,
                     'conversation_id': conversation_id
                 })
                 return
 
-            await sio.emit('chat_response', {
+            await emit_chat_response(conversation_id, {
                 'status': 'success',
                 'message': "Booking Completed. Thank you for using Brainbase",
                 'conversation_id': conversation_id
             })
 
-            current_task = task_metadata[parent_conversation_id]['current_task']
-            await sio.emit('chat_response', {
+            parent_state = conversation_store.get(parent_conversation_id)
+            if parent_state is None:
+                print(f"Parent conversation {parent_conversation_id} has expired")
+                return
+
+            current_task = "flights" if flight_context else "hotels"
+            await emit_chat_response(parent_conversation_id, {
                 'status': 'success',
                 'message': f"{current_task} booking is completed",
                 'conversation_id': parent_conversation_id
@@ -86,11 +433,11 @@ async def chat_message(sid, data):
 
             print("Parent conversation id: ", parent_conversation_id)
 
-            task_metadata[parent_conversation_id]['categories_count'] = task_metadata[parent_conversation_id]['categories_count'] - 1
-            task_metadata[parent_conversation_id]['current_status'] = False
+            parent_state.categories_count = parent_state.categories_count - 1
+            parent_state.current_status = False
 
-            if task_metadata[parent_conversation_id]['categories_count'] == 0:
-                await sio.emit('chat_response', {
+            if parent_state.categories_count == 0:
+                await emit_chat_response(parent_conversation_id, {
                     'status': 'success',
                     'message': "All tasks completed",
                     'conversation_id': parent_conversation_id
@@ -98,29 +445,19 @@ async def chat_message(sid, data):
 
                     
 
-                task_metadata[parent_conversation_id]['step_by_step']['completed'] = False
-                task_metadata[parent_conversation_id]['generic']['completed'] = False
-                task_metadata[parent_conversation_id]['step_by_step']['data'] = None
-                task_metadata[parent_conversation_id]['generic']['data'] = None
-                task_metadata[parent_conversation_id]['flights']['completed'] = False
-                task_metadata[parent_conversation_id]['hotels']['completed'] = False
-                task_metadata[parent_conversation_id]['transports']['completed'] = False
-                task_metadata[parent_conversation_id]['experiences']['completed'] = False
+                parent_state.step_by_step.completed = False
+                parent_state.generic.completed = False
+                parent_state.step_by_step.data = None
+                parent_state.generic.data = None
+                parent_state.flights.completed = False
+                parent_state.hotels.completed = False
+                parent_state.transports.completed = False
+                parent_state.experiences.completed = False
             else:
-                # Get the next task to process
-                categories = eval(task_metadata[parent_conversation_id]['ai_response'])
-                
-                # Find the next task after the current one
-                try:
-                    current_index = categories.index(current_task.capitalize())
-                    if current_index + 1 < len(categories):
-                        next_task = categories[current_index + 1]
-                        api_response = await process_task(next_task, conversation_history, sid, parent_conversation_id, categories, task_metadata)
-                        
-                except ValueError:
-                    print(f"Current task {current_task} not found in categories")
-
-                   
+                # Run whatever is still pending for the parent conversation
+                categories = json.loads(parent_state.ai_response)
+                await run_tasks(categories, parent_state.history, sid, parent_conversation_id, parent_state)
+
             return
         else:   
             print(f"Processing main chat message: {conversation_id}")
@@ -128,44 +465,24 @@ async def chat_message(sid, data):
         
         
 
-        # Initialize or reset task metadata for new conversation
-        conversation_id = conversation_history[-1].get('conversation_id')
-        # parent_conversation_id = conversation_history[-1].get('parent_conversation_id')
-        if conversation_id not in task_metadata and 'child' not in conversation_id:
-            task_metadata[conversation_id] = {
-                'flights': {'completed': False, 'data': None},
-                'hotels': {'completed': False, 'data': None},
-                'transports': {'completed': False, 'data': None},
-                'experiences': {'completed': False, 'data': None},
-                'step_by_step': {'completed': False, 'data': None},
-                'generic': {'completed': False, 'data': None},
-                'current_status': False,
-                'ai_response': None, 
-                'flight_search_completed': False,
-                'categories_count': 0,
-                'origin': "",
-                'destination': "",
-                'date': "",
-                'current_task': ""
-            }
-        
-
         print("Conversation history: ", conversation_history)
 
         message = conversation_history[-1]['message'] 
 
-        if task_metadata[conversation_id]['current_status'] == False:
-            ai_response = await identify_categories(message, conversation_history, sid, conversation_id)
-            categories = eval(ai_response)
-            task_metadata[conversation_id]['categories_count'] = len(categories)
-            task_metadata[conversation_id]['ai_response'] = ai_response
-            task_metadata[conversation_id]['current_status'] = True
+        trip = None
+        if state.current_status == False:
+            trip = await identify_trip_request(conversation_history, conversation_id, state)
+            categories = trip.categories
+            state.categories_count = len(categories)
+            state.ai_response = json.dumps(categories)
+            state.current_status = True
         else:
-            ai_response = task_metadata[conversation_id]['ai_response']
-            categories = eval(ai_response)
+            # Follow-up turn, e.g. the answer to a question for a missing detail
+            categories = json.loads(state.ai_response)
+            await fill_missing_slots(conversation_history, categories, state)
         
         if contains_generic(categories):
-            if not task_metadata[conversation_id]['generic']['completed']:
+            if not state.generic.completed:
                 print("Generic questions")
 
                 system_prompt = f'''
@@ -184,256 +501,246 @@ async def chat_message(sid, data):
                 I want only the response to the question.
                 '''
 
-                api_response = generic_gpt_response(system_prompt, message)
-
-                await sio.emit('chat_response', {
-                    'status': 'success',
-                    'message': api_response,
-                    'conversation_id': conversation_id,
-                    'from': 'ai',
-                })
-
-                task_metadata[conversation_id]['current_status'] = False
-                task_metadata[conversation_id]['categories_count'] = task_metadata[conversation_id]['categories_count'] - 1
-        else:
-            if not task_metadata[conversation_id]['step_by_step']['completed']:
-                step_by_step_response = await get_step_by_step_response(categories, sid, conversation_id)
-                task_metadata[conversation_id]['step_by_step']['completed'] = True
-                task_metadata[conversation_id]['step_by_step']['data'] = step_by_step_response
-                task_metadata[conversation_id]['generic']['completed'] = True
-                task_metadata[conversation_id]['generic']['data'] = ""
-
-
-            for task in categories:
-                api_response = await process_task(task, conversation_history, sid, conversation_id, categories, task_metadata)
-                if api_response:
-                    await sio.emit('chat_response', {
+                if trip is not None and trip.reply:
+                    # Chit-chat recognized by the local classifier has a fixed answer
+                    await emit_chat_response(conversation_id, {
                         'status': 'success',
-                        'message': api_response,
-                        'conversation_id': conversation_id
+                        'message': trip.reply,
+                        'conversation_id': conversation_id,
+                        'from': 'ai',
                     })
-                return
+                else:
+                    await generic_gpt_response(system_prompt, message, conversation_id)
+
+                state.current_status = False
+                state.categories_count = state.categories_count - 1
+        else:
+            if not state.step_by_step.completed:
+                step_by_step_response = await get_step_by_step_response(categories, sid, conversation_id, state)
+                state.step_by_step.completed = True
+                state.step_by_step.data = step_by_step_response
+                state.generic.completed = True
+                state.generic.data = ""
 
-        if task_metadata[conversation_id]['categories_count'] == 0:
 
-            task_metadata[conversation_id]['step_by_step']['completed'] = False
-            task_metadata[conversation_id]['generic']['completed'] = False
-            task_metadata[conversation_id]['step_by_step']['data'] = None
-            task_metadata[conversation_id]['generic']['data'] = None
+            await run_tasks(categories, conversation_history, sid, conversation_id, state)
 
-            print("Task metadata: ", task_metadata)
+        if state.categories_count == 0:
 
-            await sio.emit('chat_response', {
+            state.step_by_step.completed = False
+            state.generic.completed = False
+            state.step_by_step.data = None
+            state.generic.data = None
+            state.transports.completed = False
+            state.experiences.completed = False
+            state.current_status = False
+
+            await emit_chat_response(conversation_id, {
                 'status': 'success',
                 'message': "All tasks completed",
                 'conversation_id': conversation_id
             })
 
 
+
             
+    finally:
+        admission.release(admitted_at)
+        kind = 'sheet' if conversation_id.startswith('child_') else 'main'
+        CHAT_TURN_LATENCY.observe(time.perf_counter() - received_at, kind=kind)
 
-        task_metadata[conversation_id]['transports']['completed'] = True
-        task_metadata[conversation_id]['experiences']['completed'] = True
 
-            
-    except Exception as e:
-        print("Error in chat_message:", str(e))  # Add explicit error logging
-        await sio.emit('chat_response', {
-            'status': 'error',
-            'message': str(e),
-            'conversation_id': conversation_id
-        })
+def unavailable_response(error, conversation_id):
+    """A graceful chat_response for a turn that failed because a dependency is down"""
+    service = "The assistant" if error.service.startswith("OpenAI") else "Travel search"
+    if isinstance(error, CircuitOpenError):
+        message = f"{service} is temporarily unavailable. Please try again in {error.retry_after} seconds."
+    else:
+        message = f"{service} is not responding right now. Please try again in a moment."
 
+    return {
+        'status': 'error',
+        'message': message,
+        'retry_after': error.retry_after,
+        'conversation_id': conversation_id
+    }
 
-async def accessTokens():
 
-    print("Access tokens")
+async def sync_history(sid, state, data):
+    """
+    Apply the messages of a chat_message event to the server-side history.
+    Clients send only their new messages with `seq`, the sequence number of
+    the last one. If messages were lost in between, the turn is dropped and
+    the client is asked to resync by sending its full history with `resync`.
+    Returns False when a resync was requested.
+    """
+    messages = data['messages']
 
-    url = "https://test.api.amadeus.com/v1/security/oauth2/token"
+    if data.get('resync') or 'seq' not in data:
+        # Full history, from a resync or from a client that always sends everything
+        conversation_store.clear_history(state)
+        conversation_store.add_messages(state, messages)
+        state.client_seq = data.get('seq', 0)
+        return True
 
-    print(amadeus_client_id, amadeus_client_secret)
+    if data['seq'] - len(messages) != state.client_seq:
+        print(f"Sequence gap in {state.conversation_id}: have {state.client_seq}, got {data['seq']}")
+        await sio.emit('resync_required', {
+            'conversation_id': state.conversation_id,
+            'seq': state.client_seq
+        }, to=sid)
+        return False
 
-    payload = f'grant_type=client_credentials&client_id={amadeus_client_id}&client_secret={amadeus_client_secret}'
-    headers = {
-    'Content-Type': 'application/x-www-form-urlencoded'
-    }
+    conversation_store.add_messages(state, messages)
+    state.client_seq = data['seq']
+    return True
 
-    response = requests.request("POST", url, headers=headers, data=payload)
 
-    access_token = response.json()['access_token']
+async def emit_chat_response(conversation_id, response):
+    """Send a chat_response to the conversation's room and record it in the server-side history"""
+    await send_event('chat_response', response, conversation_id, record=True)
 
-    print(access_token)
 
-    return access_token
-    
+async def send_event(event, payload, room, record=False):
+    """Emit to a room, in request order when called from a scheduled category task"""
+    if not await emit_in_task_order(event, payload, room, record):
+        await deliver_event(event, payload, room, record)
+
+
+async def deliver_event(event, payload, room, record=False):
+    """
+    Emit an event to a room. With record, its message is added to the room's
+    server-side history as it is sent, so output a scheduled task buffered
+    lands in the history in the order the client sees it.
+    """
+    state = conversation_store.get(room) if record and payload.get('message') else None
+    if state is not None:
+        conversation_store.add_messages(state, [{
+            'message': payload['message'],
+            'from': 'ai',
+            'type': payload.get('type'),
+            'conversation_id': room
+        }])
+
+    with EMIT_LATENCY.time(event=event):
+        await sio.emit(event, payload, to=room)
+
+
+async def run_tasks(categories, conversation_history, sid, conversation_id, state):
+    """Run the pending category tasks of a conversation through the task scheduler"""
+    await task_scheduler.run(
+        [task.lower() for task in categories],
+        run_task=lambda task: process_task(task, conversation_history, sid, conversation_id, categories, state),
+        is_done=lambda task: state.task(task).completed,
+        send=deliver_event,
+        has_input=lambda name: bool(state.trip.get(name))
+    )
+
 
-def validate_task_info_response(response, category):
+async def send_llm_response(conversation_id, messages, response, stage='message'):
     """
-    Validates that the GPT response is in the correct format for flight information.
-    Returns (bool, dict): Tuple of (is_valid, parsed_response)
+    Generate an LLM message and send it to the conversation as a chat_response.
+    With streaming on, tokens are forwarded as 'start'/'delta'/'end' chunks
+    keyed by message_id as soon as the model produces them, and the 'end'
+    chunk carries the assembled message. Returns the full message.
     """
+    if not STREAM_RESPONSES:
+        message = await llm.complete(messages, stage=stage)
+        await emit_chat_response(conversation_id, {**response, 'message': message})
+        return message
+
+    message_id = uuid.uuid4().hex
+    await send_event('chat_response', {**response, 'stream': 'start', 'message_id': message_id}, conversation_id)
+
+    parts = []
     try:
-        # Try to evaluate the response string as a dictionary
-        response_dict = eval(response)
-        
-        # Check if it's a dictionary
-        if not isinstance(response_dict, dict):
-            print("Response is not a dictionary")
-            return False, None
-            
-        # Check if all required keys are present
-        if category == "flights":
-            required_keys = {'origin', 'destination', 'date'}
-        elif category == "hotels":
-            required_keys = {'destination', 'date'}
-        elif category == "return_journey":
-            required_keys = {'return_journey'}
-       
+        async for delta in llm.stream(messages, stage=stage):
+            parts.append(delta)
+            await send_event('chat_response', {
+                'stream': 'delta',
+                'message_id': message_id,
+                'delta': delta,
+                'conversation_id': conversation_id
+            }, conversation_id)
+    except Exception:
+        # Close the partial message on the client before the error is reported
+        await send_event('chat_response', {
+            **response,
+            'status': 'error',
+            'stream': 'end',
+            'message_id': message_id,
+            'message': ''.join(parts)
+        }, conversation_id)
+        raise
+
+    message = ''.join(parts)
+    await emit_chat_response(conversation_id, {**response, 'stream': 'end', 'message_id': message_id, 'message': message})
+    return message
 
-        if not all(key in response_dict for key in required_keys):
-            print("Missing required keys")
-            return False, None
-            
-        # Check if values are strings
-        if not all(isinstance(response_dict[key], str) for key in required_keys):
-            print("Invalid value types")
-            return False, None
-            
-        return True, response_dict
-        
-    except Exception as e:
-        print(f"Failed to parse response: {e}")
-        return False, None
 
+async def accessTokens():
+    # Cached until shortly before expiry, concurrent callers share one refresh
+    return await amadeus.tokens.get_token()
+    
 
 def is_valid_future_date(date_str):
     """
     Check if the given date string is:
     1. In a valid format (YYYY-MM-DD)
-    2. Not in the past
-    3. Updates year to current year
-    
-    Returns: str - updated_date with current year
+    2. Not in the past, a past date (e.g. a stale year from the model) is
+       moved to the next time its month and day come around
+
+    Returns: str - the date to search for
     """
     try:
         # Parse the date string
         date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-        
+
         # Get today's date
         today = datetime.now().date()
-        
-        # Update the year to current year
-        updated_date = date_obj.replace(year=today.year)
-        updated_date_str = updated_date.strftime('%Y-%m-%d')
-        
-        return updated_date_str
-        
+
+        if date_obj < today:
+            date_obj = next_occurrence(date_obj.month, date_obj.day, today)
+        return date_obj.strftime('%Y-%m-%d')
+
     except ValueError:
         raise Exception("Invalid date format. Please use YYYY-MM-DD format")
 
 
-async def search_flights(conversation_history, sid, conversation_id, categories, task_metadata, origin="", destination="", date=""):
+async def search_flights(conversation_history, sid, conversation_id, categories, state, origin="", destination="", date=""):
     print("Search flights")
-    not_all_information_available = True
-
-    while(not_all_information_available):
-        system_prompt = f'''
-            You are a flight search assistant. Your responsibility is to search for information such as origin, destination and date from the use conversation history and respond in the following format.
-
-            if all 3 information is available, then return the information in the following json format:
-            Response Example:
-            {{
-                "origin": "San Francisco",
-                "destination": "New York",
-                "date": "2025-01-01",
-            }}
-
-            if any of the information is missing, then return the information in the following json format:
-            Response Example:
-            {{
-                "origin": "San Francisco",
-                "destination": "not_available",
-                "date": "2025-01-01",
-            }}
-
-            Response Example:
-            {{
-                "origin": "San Francisco",
-                "destination": "not_available",
-                "date": "not_available",
-            }}  
-
-            Rule: Stick with the above format, no other response is allowed. You should not ask any questions.
-            '''
-            
-        formatted_messages = []
-        for msg in conversation_history:
-            if isinstance(msg, dict) and 'message' in msg:
-                # Skip messages containing card data or flight results
-                if not isinstance(msg['message'], dict) and msg.get('type') != 'flight-result':
-                    formatted_messages.append(msg['message'])
-        
-        conversation_text = "\n".join(formatted_messages)
-        
-        response = gpt_response(system_prompt, conversation_text)
 
-        print("Response: ", response)
-        is_valid, flight_info = validate_task_info_response(response, "flights")
-        
-        if not is_valid:
-            print("Invalid response format, retrying...")
-            continue
-
-        print("Flight info response:", response)
-
-        if "not_available" in flight_info['origin'] or "not_available" in flight_info['destination'] or "not_available" in flight_info['date']:
-            system_prompt = f'''
-            Based on this user response:
-            Create a clear question asking the user to provide the missing information.
-            Only ask for the missing fields, one at a time.
-            '''
-                
-            question = gpt_response(system_prompt, response)
-            
-            # Send question to user and wait for response
-            await sio.emit('chat_response', {
-                'status': 'success',
-                'message': question,
-                'requires_input': True,
-                'input_type': 'flight_info',
-                'conversation_id': conversation_id
-            })
+    trip = state.trip
+    missing = trip.missing(['Flights'])
 
-            return "Flight information is required"
-                
-        else:
-            not_all_information_available = False
-            flight_info = eval(response)
-            print("Complete flight info:", flight_info)
+    if missing:
+        # Ask for one missing detail at a time, the answer fills it in on the next turn
+        trip.asked = missing[0]
+        await emit_chat_response(conversation_id, {
+            'status': 'success',
+            'message': missing_question(missing[0]),
+            'requires_input': True,
+            'input_type': 'flight_info',
+            'conversation_id': conversation_id
+        })
 
-            origin = flight_info['origin']
-            destination = flight_info['destination']
-            date = flight_info['date']
+        return "Flight information is required"
 
-            # Validate and update the date to current year
-            updated_date = is_valid_future_date(date)
-            date = updated_date
-            
+    print("Complete flight info:", trip.filled)
 
-            # Get airport codes
-            access_token = await accessTokens()
-            origin_code = await get_airport_code(origin, access_token)
-            origin = origin_code
-            destination_code = await get_airport_code(destination, access_token)
-            destination = destination_code
+    # Validate and update the date to current year
+    updated_date = is_valid_future_date(trip.get('date'))
 
-            print("Origin: ", origin)
-            print("Destination: ", destination)
-            print("Date: ", date)
-            
-            task_metadata[conversation_id]['origin'] = origin_code
-            task_metadata[conversation_id]['destination'] = destination_code
-            task_metadata[conversation_id]['date'] = updated_date
+    # Get airport codes, cities resolved earlier in the conversation are reused
+    origin_code = await resolve_slot_code(trip, 'origin')
+    destination_code = await resolve_slot_code(trip, 'destination')
+
+    print("Origin: ", origin_code)
+    print("Destination: ", destination_code)
+    print("Date: ", updated_date)
+
+    # Hotels can start searching now, without waiting for the flight offers
+    await provide_inputs('origin', 'destination', 'date')
 
     # ReturnFlight = True
     # while(ReturnFlight == True):
@@ -483,45 +790,40 @@ async def search_flights(conversation_history, sid, conversation_id, categories,
             # Now that we have all information, perform the actual flight search
 
     try:
-        if task_metadata[conversation_id]['flight_search_completed'] == False:
-
-            access_token = await accessTokens();
+        if state.flight_search_completed == False:
 
-            print(access_token, "flight")
-
-            url = f"https://test.api.amadeus.com/v2/shopping/flight-offers?originLocationCode={origin_code}&destinationLocationCode={destination_code}&departureDate={updated_date}&adults=1&nonStop=true&currencyCode=USD"
-
-            payload = {}
-            files={}
-            headers = {
-            'Authorization': f'Bearer {access_token}'
-            }
-
-            flight_response = requests.request("GET", url, headers=headers, data=payload, files=files) 
-
-            flight_data = flight_response.json()
+            flight_data = await fetch_flight_offers(origin_code, destination_code, updated_date,
+                                                    adults=trip.get('travellers') or 1)
 
             print("flight_response: ", flight_data)
 
             # Validate flight data structure
             if isinstance(flight_data, dict) and 'data' in flight_data:
-                await sio.emit('chat_response', {
+                # Only the best ranked summaries are sent, further pages and full offers on request
+                # Only the messages about this trip, not greetings or earlier requests
+                preferred_hour = departure_preference(" ".join(trip.messages))
+                results = await results_store.save(
+                    'flights', shape_results('flights', flight_data['data'], preferred_hour)
+                )
+                conversation_store.set_task_payload(conversation_id, 'flights', results)
+
+                await emit_chat_response(conversation_id, {
                     'status': 'success',
-                    'data': flight_data['data'],
+                    **results.page(0, RESULTS_PAGE_SIZE),
                     'type': 'flight-results',
                     'message': 'Flight search completed',
                     'from': 'ai',
                     'conversation_id': conversation_id
                 })
 
-                await sio.emit('chat_response', {
+                await emit_chat_response(conversation_id, {
                 'status': 'success',
                 'message': "Flight search is completed please select a flight to book",
                 'conversation_id': conversation_id
             })
 
             else:
-                await sio.emit('chat_response', {
+                await emit_chat_response(conversation_id, {
                     'status': 'error',
                     'message': 'No flight data available, please try again',
                     'type': 'flight-results',
@@ -529,17 +831,16 @@ async def search_flights(conversation_history, sid, conversation_id, categories,
                     'conversation_id': conversation_id
                 })
 
-            task_metadata[conversation_id]['flights']['completed'] = True
-            task_metadata[conversation_id]['flights']['data'] = flight_data
+            state.flights.completed = True
 
             
-            task_metadata[conversation_id]['flight_search_completed'] = True
+            state.flight_search_completed = True
 
             return "flight search completed"
 
         else:
 
-            await sio.emit('chat_response', {
+            await emit_chat_response(conversation_id, {
                 'status': 'success',
                 'message': "Flight booking is completed",
                 'conversation_id': conversation_id
@@ -551,6 +852,8 @@ async def search_flights(conversation_history, sid, conversation_id, categories,
 
     
     
+    except UpstreamError:
+        raise
     except Exception as error:
         raise Exception(str(error))
 
@@ -559,133 +862,73 @@ async def search_flights(conversation_history, sid, conversation_id, categories,
     #     sio.handlers.pop('flight_info_response', None)
     # return "Flight search completed successfully"
 
-async def search_hotels(conversation_history, sid, conversation_id, categories, task_metadata, destination="", date=""):
-
-    access_token = await accessTokens();
-
-    destination = task_metadata[conversation_id]['destination']
-    date = task_metadata[conversation_id]['date']
-
-    await sio.emit('chat_response', {
-        'status': 'success',
-        'message': "Now booking hotel in destination",
-        'conversation_id': conversation_id
-    })
-    not_all_information_available = False
-
-    if destination == "" or date == "":
-        not_all_information_available = True
-
-    while(not_all_information_available):
-
-        system_prompt = f'''
-            You are a hotel search assistant. Your responsibility is to search for information such as destination and date from the use conversation history and respond in the following format.
-
-            if all 2 information is available, then return the information in the following json format:
-            Response Example:
-            {{
-                "destination": "JFK",
-                "date": "2025-01-01"
-            }}
-
-            if any of the information is missing, then return the information in the following json format:
-            Response Example:
-            {{
-                "destination": "JFK",
-                "date": "not_available"
-            }}  
-
-            Rule: Stick with the above format, no other response is allowed. You should not ask any questions.  
-        '''
-
-        formatted_messages = []
-        for msg in conversation_history:
-            if isinstance(msg, dict) and 'message' in msg:
-                # Skip messages containing card data or flight results
-                if not isinstance(msg['message'], dict) and msg.get('type') != 'flight-result':
-                    formatted_messages.append(msg['message'])
-        
-        conversation_text = "\n".join(formatted_messages)
-        
-        response = gpt_response(system_prompt, conversation_text)
-
-        print("Response: ", response)
-        is_valid, hotel_info = validate_task_info_response(response, "hotels")
+async def fetch_flight_offers(origin, destination, date, adults=1, non_stop=True, currency="USD"):
+    """Search flight offers through the shared cache"""
 
-        if not is_valid:
-            print("Invalid response format, retrying...")
-            continue
+    async def fetch():
+        access_token = await accessTokens()
+        return await amadeus.search_flight_offers(origin, destination, date, access_token,
+                                                  adults=adults, non_stop=non_stop, currency=currency)
 
-        print("Hotel info response:", response)
+    key = flight_offer_key(origin, destination, date, adults, non_stop, currency)
+    return await flight_offer_cache.get_or_fetch(key, fetch)
 
-        if "not_available" in hotel_info['destination'] or "not_available" in hotel_info['date']:
-            system_prompt = f'''
-            Based on this user response:
-            Create a clear question asking the user to provide the missing information.
-            Only ask for the missing fields, one at a time.
-            '''
-                
-            question = gpt_response(system_prompt, response)
-            
-            # Send question to user and wait for response
-            await sio.emit('chat_response', {
-                'status': 'success',
-                'message': question,
-                'requires_input': True,
-                'input_type': 'hotel_info',
-                'conversation_id': conversation_id
-            })
+async def search_hotels(conversation_history, sid, conversation_id, categories, state, destination="", date=""):
 
-            return "Hotel information is required"
+    trip = state.trip
+    missing = trip.missing(['Hotels'])
 
-        else:
-            not_all_information_available = False
-            hotel_info = eval(response)
-            print("Complete hotel info:", hotel_info)
+    if missing:
+        trip.asked = missing[0]
+        await emit_chat_response(conversation_id, {
+            'status': 'success',
+            'message': missing_question(missing[0]),
+            'requires_input': True,
+            'input_type': 'hotel_info',
+            'conversation_id': conversation_id
+        })
 
-            destination = hotel_info['destination']
-            date = hotel_info['date']
+        return "Hotel information is required"
 
-            task_metadata[conversation_id]['destination'] = destination
-            task_metadata[conversation_id]['date'] = date
+    await emit_chat_response(conversation_id, {
+        'status': 'success',
+        'message': "Now booking hotel in destination",
+        'conversation_id': conversation_id
+    })
 
-     
+    access_token = await accessTokens()
+    destination = await resolve_slot_code(trip, 'destination')
+    # Raises on an unusable date, hotels by city are listed without one
+    is_valid_future_date(trip.get('date'))
 
     try:
-        url = f"https://test.api.amadeus.com/v1/reference-data/locations/hotels/by-city?cityCode={destination.upper()}"
+        hotel_data = await amadeus.search_hotels_by_city(destination, access_token)
 
-        payload = {}
-        headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
+        print(hotel_data)
 
-        hotel_response = requests.request("GET", url, headers=headers, data=payload)
-
-        print(hotel_response.text)
-
-        hotel_data = hotel_response.json()
-
-        task_metadata[conversation_id]['hotels']['completed'] = True
-        task_metadata[conversation_id]['hotels']['data'] = hotel_data
+        state.hotels.completed = True
 
         if isinstance(hotel_data, dict) and 'data' in hotel_data:
-            await sio.emit('chat_response', {
+            results = await results_store.save('hotels', shape_results('hotels', hotel_data['data']))
+            conversation_store.set_task_payload(conversation_id, 'hotels', results)
+
+            await emit_chat_response(conversation_id, {
                 'status': 'success',
-                'data': hotel_data['data'],
+                **results.page(0, RESULTS_PAGE_SIZE),
                 'type': 'hotel-results',
                 'message': 'Hotel search completed',
                 'from': 'ai',
                 'conversation_id': conversation_id
             })
 
-            await sio.emit('chat_response', {
+            await emit_chat_response(conversation_id, {
                 'status': 'success',
                 'message': "Hotel search is completed please select a hotel to book",
                 'conversation_id': conversation_id
             })
 
         else:
-            await sio.emit('chat_response', {
+            await emit_chat_response(conversation_id, {
                 'status': 'error',
                 'message': 'No hotel data available, please try again',
                 'type': 'hotel-results',
@@ -694,12 +937,14 @@ async def search_hotels(conversation_history, sid, conversation_id, categories,
             })
 
         return "hotel search completed"
+    except UpstreamError:
+        raise
     except Exception as error:
         raise Exception(str(error))
 
 async def search_transfers(conversation_id, origin="", destination=""):
     try:
-        await sio.emit('chat_response', {
+        await emit_chat_response(conversation_id, {
             'status': 'success',
             'message': "Now booking car from airport to hotel",
             'conversation_id': conversation_id
@@ -707,7 +952,7 @@ async def search_transfers(conversation_id, origin="", destination=""):
 
 
 
-        await sio.emit('chat_response', {
+        await emit_chat_response(conversation_id, {
             'status': 'success',
             'message': "Car booking from airport to hotel is completed",
             'conversation_id': conversation_id
@@ -725,83 +970,48 @@ async def search_activities(latitude="", longitude=""):
         raise Exception(str(error))
     
 
-def gpt_response(system_prompt, user_prompt):
-    # Initialize messages with system prompt
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    # Handle conversation history if user_prompt is a list of message objects
-    if isinstance(user_prompt, list):
-        if isinstance(user_prompt[0], dict) and 'role' in user_prompt[0]:
-            # If it's already in the correct format with roles
-            messages.extend(user_prompt)
-        else:
-            # If it's just a list of strings, join them as user messages
-            messages.append({"role": "user", "content": "\n".join(user_prompt)})
-    else:
-        # Single string input
-        messages.append({"role": "user", "content": user_prompt})
-
-    response = client.chat.completions.create(
-        model="gpt-4-0613",
-        messages=messages,
-        temperature=0.5,
-        max_tokens=1000 
-    )
-
-    return response.choices[0].message.content
+async def gpt_response(system_prompt, user_prompt, stage='completion'):
+    messages = build_messages(system_prompt, user_prompt)
 
-def generic_gpt_response(system_prompt, user_prompt = ""):
+    return await llm.complete(messages, stage=stage)
 
-    response = client.chat.completions.create(
-        model="gpt-4-0613",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        temperature=0.5,
-        max_tokens=1000 
-    )
-
-    return response.choices[0].message.content
+async def generic_gpt_response(system_prompt, user_prompt, conversation_id):
 
-def contains_generic(strings):
-    return any("generic" in s.lower() for s in strings)
-
-
-async def get_step_by_step_response(categories, sid, conversation_id):
-    system_prompt = f'''
-        Your responsibility is to write a step by step plan using categoriesto complete the user's request.
-        
-        Example:
-
-        categories: ["Flight"]
-        Response:
-        I'll take a following steps to book a flight for you: \n
-        1. I'll search for flights from origin to destination. \n
-        2. I'll display the flights to you. \n
-        3. I'll book the flight for you. \n
+    # The answer only depends on the question, repeated small talk is served from the cache
+    cache_key = response_key('generic', user_prompt, system_prompt)
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        await emit_chat_response(conversation_id, {
+            'status': 'success',
+            'message': cached_response,
+            'conversation_id': conversation_id,
+            'from': 'ai',
+        })
+        return cached_response
 
-        categories: ["Flight", "Hotel"]
-        Response:
-        I'll take a following steps to book a flight and a hotel for you: \n
-        1. I'll search for flights from origin to destination. \n
-        2. I'll display the flights to you. \n
-        3. I'll book the flight for you. \n
-        4. I'll search for hotels in destination. \n
-        5. I'll display the hotels to you. \n
-        6. I'll book the hotel for you. \n
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
 
+    response = await send_llm_response(conversation_id, messages, {
+        'status': 'success',
+        'conversation_id': conversation_id,
+        'from': 'ai',
+    }, stage='generic')
+    response_cache.set(cache_key, response)
 
-        Your response should be a step by step plan. like the example above only response nothing else. You should stick to flight booking if message is related to flight.
-        You should stick to hotel booking if message is related to hotel. dont assume anything.
+    return response
 
+def contains_generic(strings):
+    return any("generic" in s.lower() for s in strings)
 
-            
-        '''
 
-    step_by_step_response = gpt_response(system_prompt, categories);
+async def get_step_by_step_response(categories, sid, conversation_id, state):
+    """The plan is rendered from a template, it needs no LLM call"""
+    step_by_step_response = render_plan(categories, state.trip)
 
-    await sio.emit('chat_response', {
+    await emit_chat_response(conversation_id, {
         'status': 'success',
         'message': step_by_step_response,
         'conversation_id': conversation_id,
@@ -812,91 +1022,140 @@ async def get_step_by_step_response(categories, sid, conversation_id):
     return step_by_step_response
 
 
-async def identify_categories(message, conversation_history, sid, conversation_id):
+def local_trip_request(message):
+    """
+    The trip request as the local intent classifier sees it, or None when the
+    prediction is not confident or names a city the airport index doesn't know.
+    Details the message leaves out are asked for by the category tasks, as
+    after an extraction call.
+    """
+    prediction = intent_classifier.classify(message)
+    hit = prediction.confidence >= intent_classifier.threshold
 
-    system_prompt = f'''You are a helpful trip planner assistant. your responsibility is to help the user to plan a trip using chain of thought reasoning. 
-        From user input, you will identify which tasks and which Amadeus API to use out of 
+    slots = prediction.slots if prediction.categories != ["Generic"] else {}
+    # Only cities the local airport index knows, anything else may be a misread phrase
+    if any(airport_resolver.lookup(slots[field]) is None for field in ('origin', 'destination') if field in slots):
+        hit = False
 
-        1) Flights
-        2) Transports
-        3) Hotels
-        4) Experiences
+    intent_classifier.record(hit)
+    print(f"Intent fast path {'hit' if hit else 'miss'}: {prediction}, hit rate {intent_classifier.hit_rate():.0%}")
+    if not hit:
+        return None
 
-        Example: 
-        User: I want to book a flight to New York.
-        You: ["Flights"]
+    required = {field for category in prediction.categories for field in REQUIRED_SLOTS.get(category, ())}
+    missing = [field for field in SLOT_FIELDS if field in required and not slots.get(field)]
+    return TripRequest(prediction.categories, reply=prediction.reply, missing=missing, **slots)
 
-        User: I want to book a hotel in New York.
-        You: ["Hotels"]
 
-        User: I want to book a transport from New York to Los Angeles.
-        You: ["Transports"]
+async def identify_trip_request(conversation_history, conversation_id, state):
+    """
+    Identify the requested categories and extract the trip details (origin,
+    destination, date, travellers) in a single structured-output call.
+    Requests the local classifier is confident about skip the call.
+    A new request replaces the conversation's trip details.
+    """
+    message = conversation_history[-1]['message']
+
+    trip = local_trip_request(message)
+    if trip is None:
+        print("Open AI request message: ", message)
+        response = await llm.complete(
+            build_extraction_messages(context_window_manager.build(state, 'extraction'), message),
+            model=EXTRACTION_MODEL,
+            response_format=TRIP_REQUEST_FORMAT,
+            stage='extraction'
+        )
+        try:
+            trip = parse_trip_request(response)
+        except ModelOutputError as error:
+            # Answer it as a generic message rather than paying for another extraction call
+            print(f"Unusable extraction answer: {error}")
+            trip = TripRequest(["Generic"])
+    print("Trip request: ", trip)
+
+    state.trip = TripSlots(trip.slots(), request=message)
+    await emit_chat_response(conversation_id, {
+        'status': 'success',
+        'message': json.dumps(trip.categories),
+        'conversation_id': conversation_id
+    })
 
-        User: I want to book a flight to New York and a hotel in New York.
-        You: ["Flights", "Hotels"]
+    return trip
 
-        User: Plan a trip from San Francisco to New York.
-        You: ["Flights", "Hotels"]
 
-        User: Hi, How are you?
-        You: ["Generic"]
+async def fill_missing_slots(conversation_history, categories, state):
+    """
+    Fill the trip details the pending categories still miss, and a changed
+    traveller count, from the newest message only. Plain answers ("Paris",
+    "May 3rd", "make it 3 people") are understood locally, anything else takes
+    one small extraction call limited to the missing details.
+    """
+    message = conversation_history[-1]['message']
+    if not isinstance(message, str):
+        return
+    state.trip.messages.append(message)
 
-        Make sure your response is a list of tasks and you are selecting multiple APIs to complete the tasks out of the list.
-        '''
+    missing = state.trip.missing(categories)
+    found = state.trip.fill_from_message(message, missing, lambda city: airport_resolver.lookup(city) is not None)
+    print(f"Filled {found or 'nothing'} locally, missing {missing}")
+    if found or not missing:
+        return
 
-    print("Open AI request message: ", message)
-    response = client.chat.completions.create(
-        model="gpt-4-0613",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": message}
-        ],
-        temperature=0.5,
-        max_tokens=1000 
+    question = next((msg['message'] for msg in reversed(conversation_history[:-1])
+                     if msg.get('from') == 'ai' and isinstance(msg.get('message'), str)), None)
+    response = await llm.complete(
+        build_slot_messages(question, message, missing),
+        model=EXTRACTION_MODEL,
+        response_format=slot_answer_format(missing),
+        stage='slot_filling'
     )
+    try:
+        state.trip.update(parse_slot_answer(response, missing))
+    except ModelOutputError as error:
+        # The question is asked again on this turn
+        print(f"Unusable slot answer: {error}")
 
-    print(response.choices[0].message.content)
 
-    ai_response = response.choices[0].message.content
+async def resolve_slot_code(trip, field):
+    """IATA code of a city slot, resolved once per conversation"""
+    code = trip.codes.get(field)
+    if code is None:
+        code = trip.codes[field] = await get_airport_code(trip.get(field), await accessTokens())
+    return code
 
-    await sio.emit('chat_response', {
-        'status': 'success',
-        'message': ai_response,
-        'conversation_id': conversation_id
-    })
-
-    return ai_response
-
-async def process_task(task, conversation_history, sid, conversation_id, categories, task_metadata):
+async def process_task(task, conversation_history, sid, conversation_id, categories, state):
     task_lower = task.lower()
     print("Task: ", task_lower)
     
-    if task_lower == "flights" and not task_metadata[conversation_id]['flights']['completed']:
+    if task_lower == "flights" and not state.flights.completed:
         print("I am calling search flights")
-        task_metadata[conversation_id]['current_task'] = "flights"
-        await search_flights(conversation_history, sid, conversation_id, categories, task_metadata)
+        state.current_task = "flights"
+        await search_flights(conversation_history, sid, conversation_id, categories, state)
         return
         
-    elif task_lower == "hotels" and not task_metadata[conversation_id]['hotels']['completed']:
-        task_metadata[conversation_id]['current_task'] = "hotels"
-        await search_hotels(conversation_history, sid, conversation_id, categories, task_metadata)
+    elif task_lower == "hotels" and not state.hotels.completed:
+        state.current_task = "hotels"
+        await search_hotels(conversation_history, sid, conversation_id, categories, state)
         return
     
-    elif task_lower == "transports" and not task_metadata[conversation_id]['transports']['completed']:
-        task_metadata[conversation_id]['current_task'] = "transports"
+    elif task_lower == "transports" and not state.transports.completed:
+        state.current_task = "transports"
         await search_transfers(conversation_id)
-        task_metadata[conversation_id]['transports']['completed'] = True
+        state.transports.completed = True
+        # Transfers are booked right away, there is no booking sheet to complete them
+        state.categories_count = state.categories_count - 1
         return 
         
-    elif task_lower == "experiences" and not task_metadata[conversation_id]['experiences']['completed']:
-        task_metadata[conversation_id]['current_task'] = "experiences"
+    elif task_lower == "experiences" and not state.experiences.completed:
+        state.current_task = "experiences"
         await search_activities()
-        task_metadata[conversation_id]['experiences']['completed'] = True
+        state.experiences.completed = True
+        state.categories_count = state.categories_count - 1
         return 
     
     return
 
-def follow_up_response(context, user_message, conversation_id):
+async def follow_up_response(context, user_message, conversation_id):
 
     system_prompt = f'''
 
@@ -906,47 +1165,46 @@ def follow_up_response(context, user_message, conversation_id):
 
     '''
 
-    response = gpt_response(system_prompt, user_message)
+    # Questions about the same offer get the same answer, booking requests always go to the model
+    cache_key = response_key('follow_up', user_message, system_prompt)
+    is_booking_request = "book" in normalize_question(user_message)
+    cached_response = None if is_booking_request else response_cache.get(cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    response = await gpt_response(system_prompt, user_message, stage='follow_up')
 
     if "booking" in response:
         response = "booking_completed"
+    elif not is_booking_request:
+        response_cache.set(cache_key, response)
 
     return response
 
-def is_iata_code(location):
-    """
-    Check if the given location string is an IATA airport code.
-    IATA codes are always 3 uppercase letters.
-    """
-    return bool(location and 
-               len(location) == 3 and 
-               location.isalpha() and 
-               location.isupper())
-
-# Modify the get_airport_code function to use this check:
 async def get_airport_code(city_name, access_token):
-    """Convert city name to airport code using Amadeus API if needed"""
+    """Convert city name to airport code, using the Amadeus API only if the local index misses"""
     try:
         # If it's already an IATA code, return it directly
         if is_iata_code(city_name):
             return city_name
+
+        airport_code = airport_resolver.lookup(city_name)
+        if airport_code:
+            return airport_code
             
-        url = f"https://test.api.amadeus.com/v1/reference-data/locations?subType=CITY&keyword={city_name}"
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
-        
-        response = requests.request("GET", url, headers=headers)
-        data = response.json()
+        data = await amadeus.search_locations(city_name, access_token)
         
         if 'data' in data and len(data['data']) > 0:
-            return data['data'][0]['iataCode']
+            airport_code = data['data'][0]['iataCode']
+            await airport_resolver.remember(city_name, airport_code)
+            return airport_code
         else:
             raise Exception(f"No airport code found for city: {city_name}")
             
+    except UpstreamError:
+        raise
     except Exception as error:
         raise Exception(f"Error getting airport code: {str(error)}")
 
 if __name__ == '__main__':
-    web.run_app(app, host='0.0.0.0', port=8000)
\ No newline at end of file
+    web.run_app(app, host='0.0.0.0', port=int(os.getenv('PORT', 8000)))
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""
+Local stand-ins for the OpenAI and Amadeus APIs, used by the load test.
+
+Both answer with realistic payload shapes after a configurable latency and
+fail a configurable share of requests with a 503, so retries, circuit
+breakers and caches are exercised like in production. Point the backend at
+them with OPENAI_BASE_URL=http://host:port/v1 and AMADEUS_BASE_URL=http://host:port.
+"""
+import asyncio
+import json
+import random
+import re
+
+from aiohttp import web
+
+
+CITY_CODES = {
+    "new york": "NYC", "london": "LON", "paris": "PAR", "san francisco": "SFO", "los angeles": "LAX",
+    "chicago": "CHI", "boston": "BOS", "tokyo": "TYO", "rome": "ROM", "madrid": "MAD",
+    "berlin": "BER", "amsterdam": "AMS", "barcelona": "BCN", "miami": "MIA", "seattle": "SEA",
+}
+
+_CITY = "|".join(sorted(CITY_CODES, key=len, reverse=True))
+_ROUTE = re.compile(rf"\bfrom ({_CITY}) to ({_CITY})\b")
+_DESTINATION = re.compile(rf"\b(?:to|in) ({_CITY})\b")
+_DATE = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+
+GENERIC_ANSWER = "I am a travel planning assistant designed to help you plan a trip."
+FOLLOW_UP_ANSWER = "The flight has free wifi on board and one checked bag is included."
+
+
+class UpstreamProfile:
+    """Latency and failure behaviour of one fake upstream"""
+
+    __slots__ = ('latency', 'jitter', 'error_rate')
+
+    def __init__(self, latency=0.0, jitter=0.5, error_rate=0.0):
+        self.latency = latency
+        # Latencies are spread uniformly over latency * (1 +- jitter)
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def wait(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class FakeUpstreams:
+    """Fake OpenAI chat completions and Amadeus endpoints on one aiohttp server"""
+
+    def __init__(self, llm=None, amadeus=None, stream_chunk_chars=8):
+        self.llm = llm or UpstreamProfile()
+        self.amadeus = amadeus or UpstreamProfile()
+        self.stream_chunk_chars = stream_chunk_chars
+        self.requests = {}
+        self.failures = {}
+        self.runner = None
+
+        self.app = web.Application()
+        self.app.router.add_post('/v1/chat/completions', self.chat_completions)
+        self.app.router.add_post('/v1/security/oauth2/token', self.token)
+        self.app.router.add_get('/v1/reference-data/locations', self.locations)
+        self.app.router.add_get('/v2/shopping/flight-offers', self.flight_offers)
+        self.app.router.add_get('/v1/reference-data/locations/hotels/by-city', self.hotels_by_city)
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start serving, returns the base URL (a free port is picked when port is 0)"""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        port = self.runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def _respond(self, name, profile):
+        """Count the request, wait for the simulated latency, returns an error response or None"""
+        self.requests[name] = self.requests.get(name, 0) + 1
+        await profile.wait()
+        if profile.should_fail():
+            self.failures[name] = self.failures.get(name, 0) + 1
+            return web.json_response({'error': {'message': 'Service unavailable'}}, status=503)
+        return None
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        error = await self._respond('openai', self.llm)
+        if error is not None:
+            return error
+
+        content = answer_chat(body)
+        if body.get('stream'):
+            return await self._stream(request, body, content)
+
+        return web.json_response({
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    async def _stream(self, request, body, content):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        def chunk(delta, finish_reason=None):
+            data = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        for start in range(0, len(content), self.stream_chunk_chars):
+            await response.write(chunk({'content': content[start:start + self.stream_chunk_chars]}))
+        await response.write(chunk({}, 'stop') + b"data: [DONE]\n\n")
+        return response
+
+    async def token(self, request):
+        error = await self._respond('amadeus_token', self.amadeus)
+        return error or web.json_response({'access_token': 'fake-token', 'expires_in': 1799})
+
+    async def locations(self, request):
+        error = await self._respond('amadeus_locations', self.amadeus)
+        if error is not None:
+            return error
+        keyword = request.query.get('keyword', '').lower()
+        code = CITY_CODES.get(keyword, keyword[:3].upper())
+        return web.json_response({'data': [{'iataCode': code, 'name': keyword.title(), 'subType': 'CITY'}]})
+
+    async def flight_offers(self, request):
+        error = await self._respond('amadeus_flight_offers', self.amadeus)
+        if error is not None:
+            return error
+        query = request.query
+        offers = [
+            flight_offer(index, query['originLocationCode'], query['destinationLocationCode'], query['departureDate'])
+            for index in range(int(query.get('max', 30)))
+        ]
+        return web.json_response({'meta': {'count': len(offers)}, 'data': offers, 'dictionaries': {}})
+
+    async def hotels_by_city(self, request):
+        error = await self._respond('amadeus_hotels_by_city', self.amadeus)
+        if error is not None:
+            return error
+        city = request.query['cityCode']
+        return web.json_response({'data': [hotel(index, city) for index in range(25)]})
+
+
+def answer_chat(body):
+    """The fake model's answer, chosen by the prompt's structured output schema or system prompt"""
+    messages = body['messages']
+    system = messages[0]['content'] if messages[0]['role'] == 'system' else ''
+    user = next((message['content'] for message in reversed(messages) if message['role'] == 'user'), '')
+    schema_name = (body.get('response_format') or {}).get('json_schema', {}).get('name')
+
+    if schema_name == 'trip_request':
+        return json.dumps(extract_trip(user))
+    if schema_name == 'trip_details':
+        fields = body['response_format']['json_schema']['schema']['properties']
+        trip = extract_trip(user)
+        return json.dumps({field: trip.get(field) for field in fields})
+    if 'context' in system and 'booking_completed' in system:
+        return 'booking_completed' if 'book' in user.lower() else FOLLOW_UP_ANSWER
+    return GENERIC_ANSWER
+
+
+def extract_trip(text):
+    """What the extraction model would answer for the latest message of text"""
+    latest = text.rsplit('Latest message:', 1)[-1].lower()
+    categories = [category for category, word in (('Flights', 'flight'), ('Hotels', 'hotel')) if word in latest]
+
+    trip = {'categories': categories or ['Generic'], 'origin': None, 'destination': None,
+            'date': None, 'travellers': None, 'missing': []}
+    route = _ROUTE.search(latest)
+    destination = _DESTINATION.search(latest)
+    if route:
+        trip['origin'], trip['destination'] = route.group(1).title(), route.group(2).title()
+    elif destination:
+        trip['destination'] = destination.group(1).title()
+    date = _DATE.search(latest)
+    if date:
+        trip['date'] = date.group(0)
+
+    if categories:
+        needed = ['origin', 'destination', 'date'] if 'Flights' in categories else ['destination', 'date']
+        trip['missing'] = [field for field in needed if not trip[field]]
+    return trip
+
+
+def flight_offer(index, origin, destination, date):
+    departure_hour = (6 + 3 * index) % 24
+    return {
+        'type': 'flight-offer', 'id': str(index + 1), 'source': 'GDS', 'numberOfBookableSeats': 9,
+        'itineraries': [{
+            'duration': f'PT{7 + index % 9}H{(index * 7) % 60}M',
+            'segments': [{
+                'departure': {'iataCode': origin, 'at': f'{date}T{departure_hour:02d}:00:00'},
+                'arrival': {'iataCode': destination, 'at': f'{date}T{(departure_hour + 8) % 24:02d}:30:00'},
+                'carrierCode': 'AF', 'number': str(100 + index), 'aircraft': {'code': '359'},
+                'numberOfStops': index % 2,
+            }],
+        }],
+        'price': {'currency': 'USD', 'total': f'{350 + (index * 53) % 600}.00', 'base': '300.00',
+                  'grandTotal': f'{350 + (index * 53) % 600}.00'},
+        'validatingAirlineCodes': ['AF'],
+        'travelerPricings': [{'travelerId': '1', 'fareOption': 'STANDARD', 'travelerType': 'ADULT',
+                              'fareDetailsBySegment': [{'segmentId': '1', 'cabin': 'ECONOMY', 'class': 'Y'}]}],
+    }
+
+
+def hotel(index, city):
+    return {
+        'chainCode': 'HI', 'iataCode': city, 'dupeId': 700000000 + index, 'name': f'{city} Hotel {index + 1}',
+        'hotelId': f'HI{city}{index:03d}', 'geoCode': {'latitude': 48.85 + index / 100, 'longitude': 2.35},
+        'address': {'countryCode': 'FR'}, 'distance': {'value': 0.5 + index / 10, 'unit': 'KM'},
+    }
@@ -0,0 +1,465 @@
+"""
+Load test of one backend process, fully offline.
+
+    python benchmark/load_test.py [--clients 200] [--duration 60] [--llm-latency 0.8] ...
+
+Boots app.py in a subprocess against local fake OpenAI and Amadeus endpoints
+(fake_upstreams.py), then drives concurrent python-socketio clients through
+scripted conversations: a greeting, a flight search, a flight and hotel
+search, and a flight search followed by a booking from the flight sheet.
+
+Reports turns/sec, p50/p95/p99 turn latency per scenario step, the server's
+event loop lag and memory growth (scraped from its /metrics route) and the
+client process' own loop lag, which has to stay low for the numbers to be
+trusted. With --max-p95 / --max-error-rate it exits non-zero when a run is
+over budget, so it can gate a deploy.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import aiohttp
+import socketio
+
+from fake_upstreams import FakeUpstreams, UpstreamProfile
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CITIES = ["New York", "London", "Paris", "San Francisco", "Los Angeles", "Chicago", "Boston", "Tokyo", "Rome", "Madrid"]
+
+# Default share of virtual users running each scenario
+DEFAULT_MIX = {'greeting': 2, 'flight': 3, 'flight_hotel': 3, 'sheet_booking': 2}
+
+
+class Turn:
+    """One message of a scenario and the chat_response that completes it"""
+
+    __slots__ = ('step', 'message', 'done', 'sheet', 'context')
+
+    def __init__(self, step, message, done, sheet=None, context=None):
+        self.step = step
+        self.message = message
+        self.done = done
+        # Sheet turns are sent on a child conversation of the scenario's main one
+        self.sheet = sheet
+        self.context = context
+
+
+def scenario_turns(name, rng=random):
+    """Turns of a scenario, with a random route and date so searches do not all hit the cache"""
+    origin, destination = rng.sample(CITIES, 2)
+    travel_date = (date.today() + timedelta(days=rng.randint(14, 180))).isoformat()
+    flight_request = f"Book a flight from {origin} to {destination} on {travel_date}"
+    trip_request = f"Book a flight and hotel from {origin} to {destination} on {travel_date}"
+
+    if name == 'greeting':
+        return [
+            Turn('greeting', "Hello", lambda data: data.get('message') == "All tasks completed"),
+            Turn('question', "What can you do for me?", lambda data: data.get('message') == "All tasks completed"),
+        ]
+    if name == 'flight':
+        return [Turn('flight_search', flight_request, lambda data: data.get('type') == 'flight-results')]
+    if name == 'flight_hotel':
+        return [Turn('flight_hotel_search', trip_request, lambda data: data.get('type') == 'hotel-results')]
+    if name == 'sheet_booking':
+        flight = {'id': '1', 'origin': origin, 'destination': destination, 'date': travel_date}
+        booked = lambda data: str(data.get('message', '')).startswith("Booking Completed")
+        return [
+            Turn('flight_search', flight_request, lambda data: data.get('type') == 'flight-results'),
+            Turn('sheet_question', "Is there wifi on board?", lambda data: bool(data.get('message')) and not data.get('stream'),
+                 sheet='flight', context={'flightDetails': flight}),
+            Turn('sheet_booking', "Please book this flight", booked, sheet='flight', context={'flightDetails': flight}),
+        ]
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+class TurnResult:
+    __slots__ = ('scenario', 'step', 'latency', 'outcome')
+
+    def __init__(self, scenario, step, latency, outcome):
+        self.scenario = scenario
+        self.step = step
+        self.latency = latency
+        self.outcome = outcome
+
+
+class VirtualUser:
+    """
+    One Socket.IO client running scenarios back to back, one turn at a time
+    like a person waiting for the answer, until the deadline passes.
+    """
+
+    def __init__(self, index, url, mix, results, turn_timeout, think_time, seed=None):
+        self.index = index
+        # Each user draws from its own generator, so a seeded run sends the same
+        # conversations every time (and can be replayed from a cassette)
+        self.random = random.Random(None if seed is None else f"{seed}-{index}")
+        self.url = url
+        self.mix = mix
+        self.results = results
+        self.turn_timeout = turn_timeout
+        self.think_time = think_time
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.client.on('chat_response', self.on_chat_response)
+        self.client.on('resync_required', self.on_resync_required)
+        # conversation_id -> (predicate, future) of the turn waiting for its answer
+        self.waiting = {}
+        self.seq = {}
+        # conversation_id -> retry_after of its last shed turn
+        self.retry_after = {}
+        self.shed = 0
+
+    async def on_chat_response(self, data):
+        waiter = self.waiting.get(data.get('conversation_id'))
+        if waiter is None or waiter[1].done():
+            return
+        predicate, future = waiter
+        if data.get('status') == 'busy':
+            self.retry_after[data['conversation_id']] = data.get('retry_after') or 1
+            future.set_result('busy')
+        elif data.get('status') == 'error':
+            future.set_result('error')
+        elif data.get('requires_input'):
+            # The fake model always gets every detail, a question back is a wrong answer
+            future.set_result('requires_input')
+        elif predicate(data):
+            future.set_result('ok')
+
+    async def on_resync_required(self, data):
+        waiter = self.waiting.get(data.get('conversation_id'))
+        if waiter is not None and not waiter[1].done():
+            waiter[1].set_result('resync')
+
+    async def run(self, deadline):
+        await self.client.connect(self.url, transports=['websocket'])
+        try:
+            iteration = 0
+            while time.monotonic() < deadline:
+                name = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+                await self.run_scenario(name, f"main_bench_{self.index}_{iteration}")
+                iteration += 1
+        finally:
+            await self.client.disconnect()
+
+    async def run_scenario(self, name, conversation_id):
+        for turn in scenario_turns(name, self.random):
+            target = f"child_{turn.sheet}_{conversation_id}" if turn.sheet else conversation_id
+            message = {'message': turn.message, 'from': 'user', 'conversation_id': target}
+            if turn.sheet:
+                message['parent_conversation_id'] = conversation_id
+            self.seq[target] = self.seq.get(target, 0) + 1
+            payload = {
+                'conversation_id': target,
+                'seq': self.seq[target],
+                'messages': [message],
+                'context': turn.context or {'conversation_id': target},
+            }
+
+            # Like the web client, a shed turn is sent again after retry_after,
+            # its latency counts from the first attempt
+            start = time.perf_counter()
+            while True:
+                future = asyncio.get_running_loop().create_future()
+                self.waiting[target] = (turn.done, future)
+                await self.client.emit('chat_message', payload)
+                try:
+                    outcome = await asyncio.wait_for(future, start + self.turn_timeout - time.perf_counter())
+                except asyncio.TimeoutError:
+                    outcome = 'timeout'
+                finally:
+                    del self.waiting[target]
+                if outcome != 'busy':
+                    break
+                self.shed += 1
+                retry_at = time.perf_counter() + self.retry_after[target]
+                if retry_at > start + self.turn_timeout:
+                    break
+                await asyncio.sleep(retry_at - time.perf_counter())
+            self.results.append(TurnResult(name, turn.step, time.perf_counter() - start, outcome))
+
+            if outcome != 'ok':
+                return
+            if self.think_time:
+                await asyncio.sleep(self.random.uniform(0, 2 * self.think_time))
+
+
+class LoopLagProbe:
+    """Event loop lag of the load generator itself"""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$')
+
+
+def parse_metrics(text):
+    """Prometheus text -> {(name, ((label, value), ...)): float}"""
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            pairs = tuple(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels or ''))
+            samples[(name, pairs)] = float(value)
+    return samples
+
+
+def histogram_quantile(samples, name, share):
+    """Quantile of an unlabelled histogram, the upper bound of the bucket it falls in"""
+    buckets = sorted(
+        (float(dict(labels)['le']), count) for (sample, labels), count in samples.items()
+        if sample == f"{name}_bucket"
+    )
+    if not buckets or buckets[-1][1] == 0:
+        return 0.0
+    rank = share * buckets[-1][1]
+    return next(bound for bound, count in buckets if count >= rank)
+
+
+async def scrape(session, url):
+    async with session.get(f"{url}/metrics") as response:
+        return parse_metrics(await response.text())
+
+
+async def wait_for_server(session, url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            return await scrape(session, url)
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"The server did not start within {timeout} seconds")
+
+
+def start_server(args, upstream_url, workdir):
+    env = {
+        **os.environ,
+        'OPENAI_API_KEY': 'benchmark',
+        'OPENAI_BASE_URL': f"{upstream_url}/v1",
+        'AMADEUS_CLIENT_ID': 'benchmark',
+        'AMADEUS_CLIENT_SECRET': 'benchmark',
+        'AMADEUS_BASE_URL': upstream_url,
+        'AIRPORT_LEARNED_PATH': os.path.join(workdir, 'learned_airports.json'),
+        'RESPONSE_CACHE_PATH': '',
+        'PORT': str(args.port),
+        'PYTHONUNBUFFERED': '1',
+    }
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    return subprocess.Popen([sys.executable, 'app.py'], cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def summarize(results, elapsed, before, after, probe, upstreams, shed):
+    ok = [result for result in results if result.outcome == 'ok']
+    outcomes = {}
+    for result in results:
+        outcomes[result.outcome] = outcomes.get(result.outcome, 0) + 1
+
+    steps = {}
+    for result in ok:
+        steps.setdefault((result.scenario, result.step), []).append(result.latency)
+
+    latencies = [result.latency for result in ok]
+    lag_count = after.get(('event_loop_lag_seconds_count', ()), 0) - before.get(('event_loop_lag_seconds_count', ()), 0)
+    lag_sum = after.get(('event_loop_lag_seconds_sum', ()), 0) - before.get(('event_loop_lag_seconds_sum', ()), 0)
+    memory_before = before.get(('process_resident_memory_bytes', ()), 0)
+    memory_after = after.get(('process_resident_memory_bytes', ()), 0)
+
+    return {
+        'turns': len(results),
+        'turns_per_second': round(len(ok) / elapsed, 2),
+        'outcomes': outcomes,
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else 0.0,
+        # Busy answers, each followed by a retry of the turn
+        'shed_responses': shed,
+        'latency': {
+            'p50': round(percentile(latencies, 0.50), 4),
+            'p95': round(percentile(latencies, 0.95), 4),
+            'p99': round(percentile(latencies, 0.99), 4),
+        },
+        'steps': {
+            f"{scenario}/{step}": {
+                'turns': len(values),
+                'p50': round(percentile(values, 0.50), 4),
+                'p95': round(percentile(values, 0.95), 4),
+                'p99': round(percentile(values, 0.99), 4),
+            }
+            for (scenario, step), values in sorted(steps.items())
+        },
+        'server_event_loop_lag': {
+            'mean': round(lag_sum / lag_count, 4) if lag_count else 0.0,
+            'p99_bucket': histogram_quantile(after, 'event_loop_lag_seconds', 0.99),
+        },
+        'client_event_loop_lag': {
+            'p99': round(percentile(probe.lags, 0.99), 4),
+            'max': round(max(probe.lags, default=0.0), 4),
+        },
+        'server_memory_mb': {
+            'before': round(memory_before / 2 ** 20, 1),
+            'after': round(memory_after / 2 ** 20, 1),
+            'growth': round((memory_after - memory_before) / 2 ** 20, 1),
+        },
+        'live_conversations': after.get(('live_conversations', ()), 0),
+        'admissions': {
+            dict(labels)['result']: count - before.get((sample, labels), 0)
+            for (sample, labels), count in after.items() if sample == 'chat_turn_admissions_total'
+        },
+        'upstream_requests': upstreams.requests,
+        'upstream_failures': upstreams.failures,
+    }
+
+
+def print_report(report, args):
+    print(f"\n{args.clients} clients for {args.duration}s, LLM latency {args.llm_latency}s "
+          f"(errors {args.llm_error_rate:.0%}), Amadeus latency {args.amadeus_latency}s (errors {args.amadeus_error_rate:.0%})")
+    print(f"Turns: {report['turns']}  {report['outcomes']}  error rate {report['error_rate']:.2%}  "
+          f"busy responses {report['shed_responses']}")
+    print(f"Throughput: {report['turns_per_second']} turns/s")
+    latency = report['latency']
+    print(f"Turn latency: p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s")
+    for step, stats in report['steps'].items():
+        print(f"  {step:<36} {stats['turns']:>6}  p50 {stats['p50']:.3f}s  p95 {stats['p95']:.3f}s  p99 {stats['p99']:.3f}s")
+    lag = report['server_event_loop_lag']
+    print(f"Server event loop lag: mean {lag['mean'] * 1000:.1f}ms  p99 <= {lag['p99_bucket'] * 1000:.0f}ms")
+    lag = report['client_event_loop_lag']
+    print(f"Client event loop lag: p99 {lag['p99'] * 1000:.1f}ms  max {lag['max'] * 1000:.1f}ms")
+    memory = report['server_memory_mb']
+    print(f"Server memory: {memory['before']} MB -> {memory['after']} MB ({memory['growth']:+} MB), "
+          f"{report['live_conversations']:.0f} live conversations")
+    print(f"Admissions: {', '.join(f'{result} {count:.0f}' for result, count in report['admissions'].items())}")
+    print(f"Upstream requests: {report['upstream_requests']}  failures: {report['upstream_failures']}")
+
+
+async def run(args):
+    upstreams = FakeUpstreams(
+        llm=UpstreamProfile(args.llm_latency, args.jitter, args.llm_error_rate),
+        amadeus=UpstreamProfile(args.amadeus_latency, args.jitter, args.amadeus_error_rate),
+    )
+    upstream_url = await upstreams.start()
+    url = f"http://127.0.0.1:{args.port}"
+    workdir = tempfile.mkdtemp(prefix='brainbase-benchmark-')
+    server = start_server(args, upstream_url, workdir)
+    probe = LoopLagProbe()
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            before = await wait_for_server(session, url, server)
+
+            results = []
+            users = [
+                VirtualUser(index, url, args.mix, results, args.turn_timeout, args.think_time, args.seed)
+                for index in range(args.clients)
+            ]
+            probe.start()
+            start = time.monotonic()
+            deadline = start + args.duration
+
+            async def ramp_up(user):
+                # Connections are spread over the ramp-up instead of arriving all at once
+                await asyncio.sleep(random.uniform(0, args.ramp_up))
+                await user.run(deadline)
+
+            outcomes = await asyncio.gather(*(ramp_up(user) for user in users), return_exceptions=True)
+            elapsed = time.monotonic() - start
+            probe.stop()
+
+            failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+            if failed:
+                print(f"{len(failed)} clients failed, first error: {failed[0]!r}")
+
+            after = await scrape(session, url)
+    finally:
+        server.terminate()
+        server.wait()
+        await upstreams.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return summarize(results, elapsed, before, after, probe, upstreams, sum(user.shed for user in users))
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        scenario_turns(name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--clients', type=int, default=200, help='concurrent Socket.IO clients')
+    parser.add_argument('--duration', type=float, default=60, help='seconds clients keep starting scenarios')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which clients connect')
+    parser.add_argument('--think-time', type=float, default=0.5, help='mean pause between turns of a client')
+    parser.add_argument('--turn-timeout', type=float, default=60, help='seconds before a turn counts as timed out')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='scenario weights, e.g. greeting=2,flight=3,flight_hotel=3,sheet_booking=2')
+    parser.add_argument('--llm-latency', type=float, default=0.8, help='mean fake OpenAI latency in seconds')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='share of fake OpenAI calls failing with 503')
+    parser.add_argument('--amadeus-latency', type=float, default=0.4, help='mean fake Amadeus latency in seconds')
+    parser.add_argument('--amadeus-error-rate', type=float, default=0.0, help='share of fake Amadeus calls failing with 503')
+    parser.add_argument('--jitter', type=float, default=0.5, help='latencies vary by +- this share of the mean')
+    parser.add_argument('--port', type=int, default=8765, help='port of the server under test')
+    parser.add_argument('--server-log', help='file for the server output (default: discarded)')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable scenario mixes')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--max-p95', type=float, help='exit with 1 when the p95 turn latency is above this')
+    parser.add_argument('--max-error-rate', type=float, help='exit with 1 when more turns than this share fail')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    print_report(report, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    over_budget = []
+    if args.max_p95 is not None and report['latency']['p95'] > args.max_p95:
+        over_budget.append(f"p95 {report['latency']['p95']:.3f}s > {args.max_p95}s")
+    if args.max_error_rate is not None and report['error_rate'] > args.max_error_rate:
+        over_budget.append(f"error rate {report['error_rate']:.2%} > {args.max_error_rate:.2%}")
+    if over_budget:
+        print("Over budget: " + ", ".join(over_budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+from resilience import UpstreamError
+
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+# Response fields that are never written to a cassette
+REDACTED_FIELDS = ('access_token', 'refresh_token')
+
+# Conversation the running task works for, set by the chat_message handler
+_conversation = contextvars.ContextVar('cassette_conversation', default='_shared')
+
+
+def use_conversation(conversation_id):
+    """Record and replay the upstream calls of the current task under conversation_id"""
+    _conversation.set(conversation_id or '_shared')
+
+
+def request_key(upstream, request):
+    """Stable fingerprint of an upstream request"""
+    text = json.dumps([upstream, request], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class CassetteMissError(LookupError):
+    """Replay found no recorded exchange for a request"""
+
+
+class Exchange:
+    __slots__ = ('upstream', 'key', 'latency', 'response', 'deltas', 'offsets', 'error', 'used')
+
+    def __init__(self, upstream, key, latency, response=None, deltas=None, offsets=None, error=None):
+        self.upstream = upstream
+        self.key = key
+        self.latency = latency
+        self.response = response
+        self.deltas = deltas
+        self.offsets = offsets
+        self.error = error
+        self.used = False
+
+    def to_json(self):
+        entry = {'upstream': self.upstream, 'key': self.key, 'latency': round(self.latency, 4)}
+        for field in ('response', 'deltas', 'offsets', 'error'):
+            value = getattr(self, field)
+            if value is not None:
+                entry[field] = value
+        return entry
+
+    @classmethod
+    def from_json(cls, entry):
+        return cls(entry['upstream'], entry['key'], entry['latency'], entry.get('response'),
+                   entry.get('deltas'), entry.get('offsets'), entry.get('error'))
+
+
+class Cassette:
+    """
+    Record/replay transport for the OpenAI and Amadeus calls of each
+    conversation, so the chat pipeline can be profiled and regression-tested
+    offline and deterministically.
+
+    In record mode every exchange (the final answer or UpstreamError after
+    retries, with its latency, and the deltas of streamed completions) is kept
+    per conversation and written on shutdown to <directory>/<conversation>.jsonl.gz.
+    In replay mode the exchanges are served from those files without touching
+    the network: a request gets the next unused exchange recorded with the same
+    fingerprint, else the next unused one of the same upstream (prompts that
+    changed since the recording), else one recorded by another conversation
+    (e.g. a token fetch or a coalesced search). latency_scale replays the
+    recorded latencies, scaled; 0 answers immediately.
+    """
+
+    def __init__(self, directory, mode=REPLAY, latency_scale=0.0):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._conversations = {}
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+
+    @property
+    def replaying(self):
+        return self.mode == REPLAY
+
+    async def exchange(self, upstream, request, send):
+        """Run send() and record its answer, or replay the recorded answer to request"""
+        key = request_key(upstream, request)
+        if self.replaying:
+            exchange = self._find(upstream, key)
+            await self._sleep(exchange.latency)
+            if exchange.error is not None:
+                raise UpstreamError(upstream, exchange.error)
+            return exchange.response
+
+        start = time.perf_counter()
+        try:
+            response = await send()
+        except UpstreamError as error:
+            self._record(Exchange(upstream, key, time.perf_counter() - start, error=str(error)))
+            raise
+        self._record(Exchange(upstream, key, time.perf_counter() - start, response=_redact(response)))
+        return response
+
+    async def stream(self, upstream, request, chunks):
+        """Yield the deltas of chunks and record them with their timing, or replay the recorded ones"""
+        key = request_key(upstream, request)
+        if self.replaying:
+            # chunks is never started, nothing goes upstream
+            await chunks.aclose()
+            exchange = self._find(upstream, key)
+            previous = 0.0
+            for delta, offset in zip(exchange.deltas or [], exchange.offsets or []):
+                await self._sleep(offset - previous)
+                previous = offset
+                yield delta
+            if exchange.error is not None:
+                raise UpstreamError(upstream, exchange.error)
+            return
+
+        start = time.perf_counter()
+        deltas = []
+        offsets = []
+        error = None
+        try:
+            async for delta in chunks:
+                deltas.append(delta)
+                offsets.append(round(time.perf_counter() - start, 4))
+                yield delta
+        except UpstreamError as failure:
+            error = str(failure)
+            raise
+        finally:
+            await chunks.aclose()
+            self._record(Exchange(upstream, key, time.perf_counter() - start, deltas=deltas, offsets=offsets, error=error))
+
+    def _record(self, exchange):
+        self._conversations.setdefault(_conversation.get(), []).append(exchange)
+        self.recorded += 1
+
+    def _find(self, upstream, key):
+        exchanges = self._load(_conversation.get())
+        match = (
+            next((exchange for exchange in exchanges if not exchange.used and exchange.key == key), None)
+            or next((exchange for exchange in exchanges if not exchange.used and exchange.upstream == upstream), None)
+            or self._find_shared(upstream, key)
+        )
+        if match is None:
+            self.misses += 1
+            raise CassetteMissError(f"No recorded {upstream} exchange for conversation {_conversation.get()}")
+
+        match.used = True
+        self.replayed += 1
+        return match
+
+    def _find_shared(self, upstream, key):
+        # Shared calls are replayed as often as they are asked for, they are not used up
+        for exchanges in self._conversations.values():
+            for exchange in exchanges:
+                if exchange.key == key:
+                    return Exchange(upstream, key, exchange.latency, exchange.response,
+                                    exchange.deltas, exchange.offsets, exchange.error)
+        return None
+
+    def _load(self, conversation_id):
+        exchanges = self._conversations.get(conversation_id)
+        if exchanges is None:
+            exchanges = self._conversations[conversation_id] = []
+            path = self._path(conversation_id)
+            if os.path.exists(path):
+                with gzip.open(path, 'rt') as f:
+                    exchanges.extend(Exchange.from_json(json.loads(line)) for line in f if line.strip())
+        return exchanges
+
+    def load_all(self):
+        """Load every conversation of the cassette, so calls can be shared between them"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.jsonl.gz'):
+                self._load(name[:-len('.jsonl.gz')])
+
+    def save(self):
+        """Write the recorded conversations, each file is replaced atomically"""
+        if self.mode != RECORD:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        for conversation_id, exchanges in self._conversations.items():
+            path = self._path(conversation_id)
+            tmp_path = f"{path}.tmp"
+            with gzip.open(tmp_path, 'wt') as f:
+                for exchange in exchanges:
+                    f.write(json.dumps(exchange.to_json(), separators=(',', ':')) + '\n')
+            os.replace(tmp_path, path)
+
+        print(f"Saved {self.recorded} upstream exchanges of {len(self._conversations)} conversations to {self.directory}")
+
+    def _path(self, conversation_id):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', conversation_id) + '.jsonl.gz')
+
+    async def _sleep(self, seconds):
+        if self.latency_scale > 0 and seconds > 0:
+            await asyncio.sleep(seconds * self.latency_scale)
+
+    def stats(self):
+        return {'mode': self.mode, 'recorded': self.recorded, 'replayed': self.replayed, 'misses': self.misses}
+
+
+def _redact(response):
+    if isinstance(response, dict) and any(field in response for field in REDACTED_FIELDS):
+        return {key: 'redacted' if key in REDACTED_FIELDS else value for key, value in response.items()}
+    return response
@@ -0,0 +1,135 @@
+import re
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    # Without tiktoken a token is estimated as four characters
+    _encoding = None
+
+
+# Tokens each message costs on top of its text (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Token budget for the conversation text of each prompt stage
+DEFAULT_BUDGETS = {
+    'extraction': 1500,
+}
+
+# Longest snippet of an older user message kept in the rolling summary
+SUMMARY_SNIPPET_CHARS = 120
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message):
+    """Token count of a history message, computed once and stored on the message"""
+    tokens = message.get('tokens')
+    if tokens is None:
+        tokens = message['tokens'] = count_tokens(message['message']) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+class ContextWindow:
+    """
+    Rolling summary of the turns that slid out of a conversation's window.
+    Turns are folded in once, when the window moves past them, so the summary
+    is updated incrementally instead of being rebuilt on every prompt.
+    """
+
+    __slots__ = ('summary', 'summarized_upto')
+
+    def __init__(self):
+        self.summary = []
+        # Position (in messages ever added to the history) up to which turns are summarized
+        self.summarized_upto = 0
+
+
+class ContextWindowManager:
+    """
+    Builds the conversation text for a prompt stage within its token budget.
+    The newest turns are kept while they fit, plus, even over budget, the
+    most recent user turns and the newest turn naming each known trip detail
+    the kept turns don't name: those carry the slots the extraction has to see. Older turns are replaced by a
+    short rolling summary of what the user said, capped at summary_budget.
+    """
+
+    def __init__(self, budgets=None, summary_budget=300, keep_recent=4):
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.summary_budget = summary_budget
+        self.keep_recent = keep_recent
+
+    def build(self, state, stage):
+        """Return the conversation text of state.history for the given stage"""
+        budget = self.budgets[stage]
+        first_position = state.history_offset
+        messages = [
+            (first_position + index, message) for index, message in enumerate(state.history)
+            if isinstance(message, dict) and isinstance(message.get('message'), str) and message.get('type') != 'flight-result'
+        ]
+
+        # Whole words only, "rome" is not in "chrome"
+        slot_patterns = [
+            re.compile(rf"\b{re.escape(value.lower())}\b")
+            for value in state.trip.filled.values() if isinstance(value, str) and value
+        ]
+        recent_users = [position for position, message in messages if message.get('from') == 'user'][-self.keep_recent:]
+
+        window = []
+        dropped = []
+        used = 0
+        budget_spent = False
+        for position, message in reversed(messages):
+            tokens = message_tokens(message)
+            text = message['message'].lower()
+            if not budget_spent and used + tokens <= budget - self.summary_budget:
+                window.append((position, message))
+                used += tokens
+                slot_patterns = [pattern for pattern in slot_patterns if not pattern.search(text)]
+                continue
+
+            # Everything older than the budget allows is summarized, except turns that carry slots
+            budget_spent = True
+            named = [pattern for pattern in slot_patterns if pattern.search(text)]
+            if position in recent_users or named:
+                window.append((position, message))
+                slot_patterns = [pattern for pattern in slot_patterns if pattern not in named]
+            else:
+                dropped.append((position, message))
+        window.reverse()
+        dropped.reverse()
+
+        context = self._context(state)
+        self._slide(context, dropped)
+
+        lines = [message['message'] for _, message in window]
+        if context.summary:
+            lines.insert(0, "Earlier in the conversation the user said: " + " | ".join(context.summary))
+        return "\n".join(lines)
+
+    def _context(self, state):
+        if state.context_window is None:
+            state.context_window = ContextWindow()
+        return state.context_window
+
+    def _slide(self, context, dropped):
+        # Only turns that slid out since the last prompt are added
+        new_turns = [(position, message) for position, message in dropped if position >= context.summarized_upto]
+        if not new_turns:
+            return
+
+        for _, message in new_turns:
+            if message.get('from') == 'user':
+                text = message['message']
+                if len(text) > SUMMARY_SNIPPET_CHARS:
+                    text = text[:SUMMARY_SNIPPET_CHARS].rsplit(' ', 1)[0] + '...'
+                context.summary.append(text)
+        context.summarized_upto = new_turns[-1][0] + 1
+
+        # Oldest snippets go first once the summary is over its own budget
+        while context.summary and sum(count_tokens(text) for text in context.summary) > self.summary_budget:
+            context.summary.pop(0)
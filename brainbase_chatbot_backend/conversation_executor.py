@@ -0,0 +1,55 @@
+import asyncio
+from collections import deque
+
+
+class ConversationExecutor:
+    """
+    Runs the turns of a conversation one at a time, in the order they arrive,
+    while turns of different conversations run in parallel. Each conversation
+    has a mailbox of waiting turns, created with its first turn and dropped
+    when it is empty again.
+
+    A turn runs in the task of its caller once it is at the head of its
+    mailbox, so context variables (cassette conversation, scheduled task
+    output) and cancellation work as if the caller had run it directly.
+    A turn that is cancelled while waiting leaves the mailbox without running.
+    """
+
+    def __init__(self):
+        self._mailboxes = {}
+        self.completed = 0
+
+    async def run(self, key, turn):
+        """Run turn() after the earlier turns of key, returns its result"""
+        mailbox = self._mailboxes.setdefault(key, deque())
+        ready = asyncio.get_running_loop().create_future()
+        mailbox.append(ready)
+        if len(mailbox) == 1:
+            ready.set_result(None)
+
+        try:
+            await ready
+            return await turn()
+        finally:
+            self._leave(key, mailbox, ready)
+
+    def _leave(self, key, mailbox, ready):
+        if mailbox[0] is not ready:
+            # Cancelled before its turn came
+            mailbox.remove(ready)
+            return
+
+        mailbox.popleft()
+        self.completed += 1
+        if mailbox:
+            mailbox[0].set_result(None)
+        else:
+            del self._mailboxes[key]
+
+    def __len__(self):
+        """Conversations with a turn running"""
+        return len(self._mailboxes)
+
+    def waiting(self):
+        """Turns waiting for an earlier turn of their conversation"""
+        return sum(len(mailbox) - 1 for mailbox in self._mailboxes.values())
@@ -0,0 +1,244 @@
+import itertools
+import json
+import time
+from collections import OrderedDict
+
+from slot_filling import TripSlots
+
+
+TASK_NAMES = ('flights', 'hotels', 'transports', 'experiences', 'step_by_step', 'generic')
+
+# Rough fixed cost of one conversation record, used for the memory cap
+STATE_OVERHEAD_BYTES = 2048
+
+# Oldest messages are dropped from the server-side history past this length
+MAX_HISTORY_MESSAGES = 200
+
+# Longer message texts are cut to this length in the history
+MAX_MESSAGE_CHARS = 4000
+
+# Rough fixed cost of one history message on top of its JSON size
+MESSAGE_OVERHEAD_BYTES = 256
+
+
+class TaskState:
+    __slots__ = ('completed', 'data')
+
+    def __init__(self):
+        self.completed = False
+        self.data = None
+
+
+class ConversationState:
+    """
+    Per-conversation task state. Large search results are not kept inline,
+    `data` on the flights/hotels tasks holds a payload reference into the store.
+    """
+
+    __slots__ = (
+        'conversation_id', 'flights', 'hotels', 'transports', 'experiences', 'step_by_step', 'generic',
+        'current_status', 'ai_response', 'flight_search_completed', 'categories_count',
+        'trip', 'current_task', 'payload_refs', 'history', 'history_offset', 'history_sizes', 'history_bytes',
+        'context_window', 'client_seq', 'last_access'
+    )
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        for name in TASK_NAMES:
+            setattr(self, name, TaskState())
+        self.current_status = False
+        self.ai_response = None
+        self.flight_search_completed = False
+        self.categories_count = 0
+        # Trip details (origin, destination, date, travellers) and their IATA codes
+        self.trip = TripSlots()
+        self.current_task = ""
+        self.payload_refs = []
+        # Authoritative message history, the client only sends new messages
+        self.history = []
+        # Number of messages trimmed from the front of the history
+        self.history_offset = 0
+        # Estimated memory of each history message as it was added, and their total,
+        # for the store's memory cap (messages gain a cached token count later)
+        self.history_sizes = []
+        self.history_bytes = 0
+        # Rolling summary of the turns that no longer fit the prompt context
+        self.context_window = None
+        # Sequence number of the last client message applied to the history
+        self.client_seq = 0
+        self.last_access = time.monotonic()
+
+    def task(self, name):
+        return getattr(self, name)
+
+    def add_messages(self, messages):
+        """Append messages to the history, returns the change of history_bytes"""
+        before = self.history_bytes
+        for message in messages:
+            message = _capped(message)
+            size = _message_bytes(message)
+            self.history.append(message)
+            self.history_sizes.append(size)
+            self.history_bytes += size
+
+        if len(self.history) > MAX_HISTORY_MESSAGES:
+            trimmed = len(self.history) - MAX_HISTORY_MESSAGES
+            self.history_bytes -= sum(self.history_sizes[:trimmed])
+            del self.history[:trimmed]
+            del self.history_sizes[:trimmed]
+            self.history_offset += trimmed
+        return self.history_bytes - before
+
+    def clear_history(self):
+        """Drop the history, returns the change of history_bytes"""
+        freed = self.history_bytes
+        self.history = []
+        self.history_offset = 0
+        self.history_sizes = []
+        self.history_bytes = 0
+        self.context_window = None
+        return -freed
+
+
+def _capped(message):
+    text = message.get('message') if isinstance(message, dict) else None
+    if isinstance(text, str) and len(text) > MAX_MESSAGE_CHARS:
+        return {**message, 'message': text[:MAX_MESSAGE_CHARS]}
+    return message
+
+
+def _message_bytes(message):
+    return MESSAGE_OVERHEAD_BYTES + len(json.dumps(message, default=str))
+
+
+class ConversationStore:
+    """
+    Bounded store for conversation state.
+    Conversations idle for longer than idle_ttl are dropped, and the least
+    recently used ones are evicted once there are more than max_conversations
+    or the estimated memory (records, histories and payloads) goes over max_bytes.
+    Histories are changed through add_messages() and clear_history() so the
+    store keeps count of their size.
+    Payloads belong to the conversation that stored them and are evicted with it.
+    A payload can report its own size (`nbytes`) and be told when it is
+    dropped (`release()`), e.g. search results whose full offers live on disk.
+    """
+
+    def __init__(self, idle_ttl=3600, max_conversations=10000, max_bytes=128 * 1024 * 1024):
+        self.idle_ttl = idle_ttl
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self._states = OrderedDict()
+        self._payloads = {}
+        self._payload_ids = itertools.count(1)
+        self.payload_bytes = 0
+        self.history_bytes = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, conversation_id):
+        return conversation_id in self._states
+
+    def get(self, conversation_id):
+        """Return the state for a conversation, or None if it is unknown or expired"""
+        self._evict_idle()
+
+        state = self._states.get(conversation_id)
+        if state is not None:
+            self._touch(state)
+        return state
+
+    def get_or_create(self, conversation_id):
+        state = self.get(conversation_id)
+        if state is None:
+            state = ConversationState(conversation_id)
+            self._states[conversation_id] = state
+            self._enforce_limits()
+        return state
+
+    def _touch(self, state):
+        state.last_access = time.monotonic()
+        self._states.move_to_end(state.conversation_id)
+
+    def add_messages(self, state, messages):
+        """Append messages to a conversation's history, evicting others past the memory cap"""
+        growth = state.add_messages(messages)
+        if self._states.get(state.conversation_id) is state:
+            self.history_bytes += growth
+            self._enforce_limits()
+
+    def clear_history(self, state):
+        freed = state.clear_history()
+        if self._states.get(state.conversation_id) is state:
+            self.history_bytes += freed
+
+    def put_payload(self, conversation_id, payload):
+        """Store a large payload for a conversation and return its reference"""
+        state = self.get_or_create(conversation_id)
+
+        ref = f"{conversation_id}:{next(self._payload_ids)}"
+        size = getattr(payload, 'nbytes', None) or len(json.dumps(payload))
+        self._payloads[ref] = (payload, size)
+        self.payload_bytes += size
+        state.payload_refs.append(ref)
+
+        self._enforce_limits()
+        return ref
+
+    def set_task_payload(self, conversation_id, task_name, payload):
+        """Store a task's result payload, replacing the one from a previous search"""
+        task = self.get_or_create(conversation_id).task(task_name)
+        previous_ref = task.data
+        task.data = self.put_payload(conversation_id, payload)
+        if previous_ref:
+            self.drop_payload(previous_ref)
+        return task.data
+
+    def get_payload(self, ref):
+        entry = self._payloads.get(ref) if ref else None
+        return entry[0] if entry else None
+
+    def drop_payload(self, ref):
+        self._release(ref)
+
+        state = self._states.get(ref.rsplit(':', 1)[0])
+        if state is not None and ref in state.payload_refs:
+            state.payload_refs.remove(ref)
+
+    def remove(self, conversation_id):
+        state = self._states.pop(conversation_id, None)
+        if state is not None:
+            self.history_bytes -= state.history_bytes
+            for ref in state.payload_refs:
+                self._release(ref)
+
+    def _release(self, ref):
+        entry = self._payloads.pop(ref, None)
+        if entry is not None:
+            self.payload_bytes -= entry[1]
+            release = getattr(entry[0], 'release', None)
+            if release is not None:
+                release()
+
+    def memory_bytes(self):
+        return len(self._states) * STATE_OVERHEAD_BYTES + self.history_bytes + self.payload_bytes
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._states:
+            oldest = next(iter(self._states.values()))
+            if oldest.last_access > deadline:
+                break
+            self.remove(oldest.conversation_id)
+            self.evictions += 1
+
+    def _enforce_limits(self):
+        # Never evict the most recently used conversation, it is the one being served
+        while len(self._states) > 1 and (
+            len(self._states) > self.max_conversations or self.memory_bytes() > self.max_bytes
+        ):
+            oldest_id = next(iter(self._states))
+            self.remove(oldest_id)
+            self.evictions += 1
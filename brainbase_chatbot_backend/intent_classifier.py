@@ -0,0 +1,199 @@
+import json
+import math
+import os
+import re
+
+from slot_filling import CITY_FIELDS, extract_slot_phrases, normalize_text, parse_date
+
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'intent_model.json')
+
+# Predictions below this confidence fall back to the LLM
+DEFAULT_THRESHOLD = 0.9
+
+# Chit-chat the assistant answers with a fixed reply, no LLM call needed
+REPLY_RULES = [
+    (re.compile(r"^(hi|hello|hey|hiya|good (morning|afternoon|evening))( there)?( brainbase)?$"),
+     "Hello! How can I help you with your trip planning?"),
+    (re.compile(r"^how are you( doing)?( today)?$"),
+     "I'm doing well, thank you! How can I help you with your trip planning?"),
+    (re.compile(r"^(what is|whats) your name$|^who are you$"),
+     "I am Brainbase."),
+    (re.compile(r"^what (do|can) you do$|^how can you help( me)?$"),
+     "I am a travel planning assistant designed to help you plan a trip."),
+    (re.compile(r"^(thanks|thank you)( so much| very much)?$"),
+     "You're welcome! Let me know if there is anything else I can help you with."),
+]
+
+CATEGORY_KEYWORDS = {
+    "Flights": re.compile(r"\b(flights?|fly|flying|plane|airline|airfare)\b"),
+    "Hotels": re.compile(r"\b(hotels?|stay|room|accommodation|lodging)\b"),
+    "Transports": re.compile(r"\b(car|taxi|cab|transfers?|transport|shuttle|ride)\b"),
+    "Experiences": re.compile(r"\b(experiences?|activities|activity|tours?|things to do|sightseeing)\b"),
+}
+
+# Date phrases the slot parser does not read, a message with one goes to the LLM
+# rather than being asked for a date it already gave
+RELATIVE_DATE = re.compile(
+    r"\b(today|tonight|tomorrow|weekend|next|this (week|month|year)|in \d+ (days|weeks|months)|"
+    r"(mon|tues|wednes|thurs|fri|satur|sun)day|jan(uary)?|feb(ruary)?|march|april|june|july|aug(ust)?|"
+    r"sept?(ember)?|oct(ober)?|nov(ember)?|dec(ember)?)\b"
+)
+
+# Party sizes the slot parser does not read ("two adults", "my family"), a flight
+# request with one goes to the LLM rather than being searched for one adult
+PARTY_SIZE = re.compile(
+    r"\b(people|persons|adults|travell?ers|passengers|tickets|of us|family|kids|children|"
+    r"wife|husband|partner|friends|couple)\b"
+)
+
+def normalize_message(text):
+    return re.sub(r"[^a-z0-9 '-]+", " ", text.lower()).replace("'", "").split()
+
+
+def mask_slots(text):
+    """
+    Replace the date and city phrases of a normalized message by placeholders,
+    so the model learns how requests are phrased rather than which places they
+    name: "book a flight to new york on 2026-12-05" -> "book a flight to <city> on <date>"
+    """
+    match, _ = parse_date(text)
+    if match:
+        text = f"{text[:match.start()]}<date>{text[match.end():]}"
+
+    slots = extract_slot_phrases(text)
+    for field in CITY_FIELDS:
+        if slots.get(field) and slots[field] != "<date>":
+            text = re.sub(rf"\b{re.escape(slots[field])}\b", "<city>", text)
+    return text
+
+
+def tokenize(text):
+    """Unigrams and bigrams of the normalized message, cities and dates masked"""
+    words = mask_slots(normalize_text(text)).split()
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def train(examples, smoothing=1.0):
+    """
+    Train a multinomial naive Bayes model on (text, label) pairs.
+    Labels are category lists joined with '+', e.g. "Flights+Hotels".
+    Returns a JSON-serializable model for IntentClassifier.
+    """
+    counts = {}
+    label_totals = {}
+    vocabulary = set()
+    for text, label in examples:
+        label_totals[label] = label_totals.get(label, 0) + 1
+        token_counts = counts.setdefault(label, {})
+        for token in tokenize(text):
+            token_counts[token] = token_counts.get(token, 0) + 1
+            vocabulary.add(token)
+
+    model = {"priors": {}, "likelihoods": {}, "unknown": {}}
+    for label, token_counts in counts.items():
+        denominator = sum(token_counts.values()) + smoothing * (len(vocabulary) + 1)
+        model["priors"][label] = math.log(label_totals[label] / len(examples))
+        model["likelihoods"][label] = {
+            token: round(math.log((count + smoothing) / denominator), 4) for token, count in token_counts.items()
+        }
+        model["unknown"][label] = round(math.log(smoothing / denominator), 4)
+
+    return model
+
+
+class IntentPrediction:
+    __slots__ = ('categories', 'confidence', 'source', 'reply', 'slots')
+
+    def __init__(self, categories, confidence, source, reply=None, slots=None):
+        self.categories = categories
+        self.confidence = confidence
+        self.source = source
+        self.reply = reply
+        self.slots = slots or {}
+
+    def __repr__(self):
+        return f"IntentPrediction({self.categories}, confidence={self.confidence:.2f}, source={self.source})"
+
+
+class IntentClassifier:
+    """
+    Local fast path in front of the LLM extraction call.
+    Fixed-reply chit-chat is matched by rules. Other messages are scored by a
+    bag-of-words naive Bayes model trained offline (train_intent_classifier.py)
+    and loaded at startup. Simple route, destination and date phrases are
+    picked up so obvious requests like "book a flight from Boston to Paris on
+    2025-05-01" need no extraction call. Callers take the prediction only
+    when its confidence reaches the threshold, and record whether they did.
+    """
+
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, threshold=DEFAULT_THRESHOLD):
+        self.model_path = model_path
+        self.threshold = threshold
+        self.model = None
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not self.model_path:
+            return
+        if not os.path.exists(self.model_path):
+            print(f"No intent model at {self.model_path}, only the rules are used")
+            return
+
+        with open(self.model_path) as f:
+            self.model = json.load(f)
+
+        print(f"Loaded intent model with labels {sorted(self.model['priors'])}")
+
+    def classify(self, message):
+        text = " ".join(normalize_message(message))
+
+        for pattern, reply in REPLY_RULES:
+            if pattern.match(text):
+                return IntentPrediction(["Generic"], 1.0, 'rule', reply=reply)
+
+        label, confidence = self._score(text)
+        categories = label.split("+") if label else ["Generic"]
+
+        # The model only decides between categories the message actually names
+        mentioned = [category for category, pattern in CATEGORY_KEYWORDS.items() if pattern.search(text)]
+        if sorted(categories) != sorted(mentioned or ["Generic"]):
+            confidence = 0.0
+
+        slots = extract_slot_phrases(normalize_text(message))
+        if "date" not in slots and RELATIVE_DATE.search(text):
+            confidence = 0.0
+        if "travellers" not in slots and "Flights" in categories and PARTY_SIZE.search(text):
+            confidence = 0.0
+
+        return IntentPrediction(categories, confidence, 'model', slots=slots)
+
+    def _score(self, text):
+        if self.model is None:
+            return None, 0.0
+
+        tokens = tokenize(text)
+        scores = {}
+        for label, prior in self.model["priors"].items():
+            likelihoods = self.model["likelihoods"][label]
+            unknown = self.model["unknown"][label]
+            scores[label] = prior + sum(likelihoods.get(token, unknown) for token in tokens)
+
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1.0 / total
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate(), 3)}
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+from metrics import LLM_LATENCY
+from resilience import Upstream, UpstreamError
+
+
+def is_retryable(error):
+    return isinstance(error, (asyncio.TimeoutError, APIConnectionError, RateLimitError, InternalServerError))
+
+
+class LLMGateway:
+    """
+    Single entry point for every OpenAI chat completion made by the backend.
+    Uses the async client so a slow completion never blocks the event loop,
+    caps the number of in-flight completions and applies a per-call timeout.
+    Transient failures are retried with backoff and a circuit breaker fails
+    calls fast while OpenAI is down (see resilience.Upstream). A concurrency
+    slot is only held by an attempt, never during the backoff between two.
+    With a cassette the calls are recorded, or replayed without OpenAI.
+    """
+
+    def __init__(self, api_key, model="gpt-4-0613", max_concurrency=8, timeout=60.0, max_retries=2, cassette=None):
+        self.model = model
+        self.timeout = timeout
+        self.cassette = cassette
+        # Retries are done by the upstream policy, not by the OpenAI client
+        self.client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.upstream = Upstream("OpenAI", max_retries=max_retries, is_retryable=is_retryable)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def complete(self, messages, temperature=0.5, max_tokens=1000, timeout=None,
+                       model=None, response_format=None, stage='completion'):
+        """
+        Run one chat completion and return the message content.
+        response_format is passed through for structured (JSON schema) output,
+        stage labels the call's latency in the metrics.
+        """
+        timeout = timeout or self.timeout
+        request = {
+            'model': model or self.model,
+            'messages': messages,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+        }
+        if response_format:
+            request['response_format'] = response_format
+
+        async def attempt():
+            async with self._semaphore:
+                return await asyncio.wait_for(
+                    self.client.chat.completions.create(**request, timeout=timeout),
+                    timeout
+                )
+
+        async def send():
+            response = await self.upstream.call(attempt)
+            return response.choices[0].message.content
+
+        with LLM_LATENCY.time(stage=stage):
+            if self.cassette is not None:
+                return await self.cassette.exchange("OpenAI", request, send)
+            return await send()
+
+    async def stream(self, messages, temperature=0.5, max_tokens=1000, timeout=None, stage='completion'):
+        """
+        Run one chat completion in streaming mode, yielding content deltas as
+        the model produces them. The timeout covers the whole completion.
+        Only opening the stream is retried, a failure after the first delta
+        is raised as UpstreamError.
+        """
+        request = {
+            'model': self.model,
+            'messages': messages,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+            'stream': True,
+        }
+        deltas = self._stream(request, timeout or self.timeout)
+        if self.cassette is not None:
+            deltas = self.cassette.stream("OpenAI", request, deltas)
+
+        start = time.perf_counter()
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+            LLM_LATENCY.observe(time.perf_counter() - start, stage=stage)
+
+    async def _stream(self, request, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        async def open_stream():
+            # The slot of a successful attempt is kept until the stream is closed
+            await self._semaphore.acquire()
+            try:
+                return await asyncio.wait_for(
+                    self.client.chat.completions.create(**request, timeout=timeout),
+                    max(deadline - loop.time(), 0.001)
+                )
+            except BaseException:
+                self._semaphore.release()
+                raise
+
+        stream = await self.upstream.call(open_stream)
+        try:
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                except Exception as error:
+                    if not is_retryable(error):
+                        raise
+                    self.upstream.breaker.record_failure()
+                    raise UpstreamError("OpenAI", f"OpenAI stream failed: {str(error) or type(error).__name__}") from error
+
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            try:
+                await stream.close()
+            finally:
+                self._semaphore.release()
+
+
+def build_messages(system_prompt, user_prompt):
+    """
+    Build the chat message list for a system prompt and a user prompt.
+    The user prompt can be a single string, a list of strings or a list of
+    message objects that already carry a role.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+
+    if isinstance(user_prompt, list):
+        if user_prompt and isinstance(user_prompt[0], dict) and 'role' in user_prompt[0]:
+            # If it's already in the correct format with roles
+            messages.extend(user_prompt)
+        else:
+            # If it's just a list of strings, join them as user messages
+            messages.append({"role": "user", "content": "\n".join(user_prompt)})
+    else:
+        # Single string input
+        messages.append({"role": "user", "content": user_prompt})
+
+    return messages
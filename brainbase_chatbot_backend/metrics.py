@@ -0,0 +1,203 @@
+import asyncio
+import bisect
+import os
+import resource
+import time
+
+
+# Latency buckets in seconds, from fast local work up to slow LLM completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = [*zip(self.labels, key), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{self._label_text(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from callback() at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+        self._values = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in values.items()]
+        return [f"{self.name}{self._label_text(key)} {value}" for key, value in self._values.items()]
+
+
+class CallbackCounter(Gauge):
+    """A counter kept by another object (e.g. cache hits), read at scrape time"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, callback, labels=()):
+        super().__init__(name, help_text, labels, callback=callback)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # label key -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        lines = []
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._label_text(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """Collects metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), callback=None):
+        return self.register(Gauge(name, help_text, labels, callback))
+
+    def callback_counter(self, name, help_text, callback, labels=()):
+        return self.register(CallbackCounter(name, help_text, callback, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+def process_memory_bytes():
+    """Resident set size of this process, the peak RSS where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+async def monitor_event_loop(histogram, interval=0.25):
+    """
+    Observe how late the event loop wakes up a sleeping task. A lag well above
+    zero means some handler blocks the loop and every connection waits for it.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - start - interval))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Metrics recorded by the shared modules, the app registers its own next to them
+REGISTRY = Registry()
+
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    'upstream_request_seconds', 'Latency of each upstream attempt (OpenAI, Amadeus endpoints)', ('upstream', 'outcome'))
+UPSTREAM_RETRIES = REGISTRY.counter('upstream_retries_total', 'Retried upstream attempts', ('upstream',))
+UPSTREAM_FAILURES = REGISTRY.counter(
+    'upstream_failures_total', 'Upstream calls that failed after their retries or with an open circuit', ('upstream', 'reason'))
+LLM_LATENCY = REGISTRY.histogram('llm_call_seconds', 'Latency of LLM calls per prompt stage, retries included', ('stage',))
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    'event_loop_lag_seconds', 'How late the event loop runs a task that is due',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+REGISTRY.gauge('process_resident_memory_bytes', 'Resident memory of the process', callback=process_memory_bytes)
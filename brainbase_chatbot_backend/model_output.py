@@ -0,0 +1,114 @@
+import ast
+import json
+import re
+
+
+# Longer answers are not something the prompts ask for, don't try to repair them
+MAX_OUTPUT_CHARS = 100000
+
+JSON_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool,
+    'null': type(None),
+}
+
+# A quoted string (double or single quotes) or one of the tokens we repair outside strings
+_TOKENS = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|,(?=\s*[}\]])|\b(?:null|true|false)\b')
+_PYTHON_LITERALS = {'null': 'None', 'true': 'True', 'false': 'False'}
+_CODE_FENCE = re.compile(r'^```[\w-]*\s*\n?|\n?\s*```$')
+
+
+class ModelOutputError(ValueError):
+    """Model output that can't be parsed or doesn't match its schema"""
+
+
+def loads(content):
+    """
+    Parse a JSON answer from the model without evaluating it.
+    Common quirks are repaired locally: code fences, text around the JSON,
+    trailing commas, single quotes and Python-style None/True/False.
+    Raises ModelOutputError when the answer still can't be parsed.
+    """
+    if not isinstance(content, str) or not content.strip():
+        raise ModelOutputError("Empty model output")
+    if len(content) > MAX_OUTPUT_CHARS:
+        raise ModelOutputError(f"Model output is too long ({len(content)} characters)")
+
+    text = _CODE_FENCE.sub('', content.strip())
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    text = _extract_json(text)
+    try:
+        return json.loads(_repair(text, python=False))
+    except ValueError:
+        pass
+
+    # Single-quoted strings are only valid as Python literals
+    try:
+        return ast.literal_eval(_repair(text, python=True))
+    except (ValueError, SyntaxError, MemoryError, RecursionError) as error:
+        raise ModelOutputError(f"Could not parse model output: {error}") from None
+
+
+def _extract_json(text):
+    """Cut the outermost object or array out of surrounding prose"""
+    starts = [index for index in (text.find('{'), text.find('[')) if index != -1]
+    if not starts:
+        return text
+    start = min(starts)
+    end = text.rfind('}' if text[start] == '{' else ']')
+    return text[start:end + 1] if end > start else text[start:]
+
+
+def _repair(text, python):
+    def replace(match):
+        token = match.group(0)
+        if token == ',':
+            return ''
+        if python:
+            return _PYTHON_LITERALS.get(token, token)
+        return token
+
+    return _TOKENS.sub(replace, text)
+
+
+def validate(value, schema, path='$'):
+    """
+    Check a parsed value against a JSON schema (the subset used for the
+    structured output formats: type, enum, properties, required, items and
+    additionalProperties). Raises ModelOutputError on the first mismatch.
+    """
+    types = schema.get('type')
+    if types is not None:
+        types = [types] if isinstance(types, str) else types
+        # bool is an int subclass, it only matches a boolean type
+        if not any(isinstance(value, JSON_TYPES[name]) and not (isinstance(value, bool) and name in ('integer', 'number'))
+                   for name in types):
+            raise ModelOutputError(f"{path}: expected {' or '.join(types)}, got {type(value).__name__}")
+
+    if 'enum' in schema and value not in schema['enum']:
+        raise ModelOutputError(f"{path}: {value!r} is not one of {schema['enum']}")
+
+    if isinstance(value, dict):
+        properties = schema.get('properties', {})
+        for key in schema.get('required', ()):
+            if key not in value:
+                raise ModelOutputError(f"{path}: missing {key!r}")
+        for key, item in value.items():
+            if key in properties:
+                validate(item, properties[key], f"{path}.{key}")
+            elif schema.get('additionalProperties') is False:
+                raise ModelOutputError(f"{path}: unexpected {key!r}")
+
+    if isinstance(value, list) and 'items' in schema:
+        for index, item in enumerate(value):
+            validate(item, schema['items'], f"{path}[{index}]")
+
+    return value
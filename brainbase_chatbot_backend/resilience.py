@@ -0,0 +1,160 @@
+import asyncio
+import random
+import time
+
+from metrics import UPSTREAM_FAILURES, UPSTREAM_LATENCY, UPSTREAM_RETRIES
+
+
+class UpstreamError(Exception):
+    """An upstream dependency failed, after any retries it was allowed"""
+
+    def __init__(self, service, message, retry_after=None):
+        super().__init__(message)
+        self.service = service
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamError):
+    """The circuit for a dependency is open, the call was not attempted"""
+
+
+class RetryBudget:
+    """
+    Caps retries at a fraction of the calls made, so an outage can't turn
+    every request into several. Each call deposits `ratio` tokens, each retry
+    spends one; `min_tokens` keeps a few retries available at low traffic.
+    """
+
+    def __init__(self, ratio=0.2, min_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = min_tokens
+        self._tokens = float(min_tokens)
+
+    def deposit(self):
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and fails calls fast
+    for reset_timeout seconds. After that a single trial call is let through,
+    its success closes the circuit and its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._trial_running = False
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        if self.state == self.CLOSED:
+            return
+
+        retry_after = self._opened_at + self.reset_timeout - time.monotonic()
+        if self.state == self.OPEN and retry_after <= 0:
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return
+
+        raise CircuitOpenError(self.name, f"{self.name} is unavailable", retry_after=max(1, round(retry_after)))
+
+    def release_trial(self):
+        self._trial_running = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                print(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+        self._trial_running = False
+
+
+class Upstream:
+    """
+    Resilience policy for one upstream endpoint: an optional timeout per
+    attempt, capped retries of transient failures with full-jitter exponential
+    backoff, a shared retry budget and a circuit breaker.
+    Failures that exhaust the retries are raised as UpstreamError.
+    """
+
+    def __init__(self, name, timeout=None, max_retries=2, base_delay=0.5, max_delay=8.0,
+                 breaker=None, budget=None, is_retryable=None):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.budget = budget or RetryBudget()
+        self.is_retryable = is_retryable or (lambda error: isinstance(error, (asyncio.TimeoutError, OSError)))
+        self.retries = 0
+
+    async def call(self, fn):
+        """Run fn(), a zero argument coroutine function, under the policy"""
+        self.budget.deposit()
+        attempt = 0
+
+        while True:
+            try:
+                self.breaker.check()
+            except CircuitOpenError:
+                UPSTREAM_FAILURES.inc(upstream=self.name, reason='circuit_open')
+                raise
+
+            start = time.perf_counter()
+            try:
+                if self.timeout:
+                    result = await asyncio.wait_for(fn(), self.timeout)
+                else:
+                    result = await fn()
+            except asyncio.CancelledError:
+                # The caller gave up, that says nothing about the dependency
+                self.breaker.release_trial()
+                raise
+            except Exception as error:
+                retryable = self.is_retryable(error)
+                UPSTREAM_LATENCY.observe(time.perf_counter() - start, upstream=self.name,
+                                         outcome='failure' if retryable else 'rejected')
+                if not retryable:
+                    # The dependency answered, e.g. a bad request, so it is up
+                    self.breaker.record_success()
+                    raise
+
+                self.breaker.record_failure()
+                if attempt >= self.max_retries or not self.budget.withdraw():
+                    UPSTREAM_FAILURES.inc(upstream=self.name, reason='retries_exhausted')
+                    raise UpstreamError(self.name, f"{self.name} failed: {str(error) or type(error).__name__}") from error
+
+                attempt += 1
+                self.retries += 1
+                UPSTREAM_RETRIES.inc(upstream=self.name)
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"Retrying {self.name} in {delay:.2f}s (attempt {attempt}): {str(error) or type(error).__name__}")
+                await asyncio.sleep(delay)
+                continue
+
+            UPSTREAM_LATENCY.observe(time.perf_counter() - start, upstream=self.name, outcome='success')
+            self.breaker.record_success()
+            return result
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+
+def normalize_question(text):
+    """Lowercase, drop punctuation and collapse whitespace: "Hi!!  " -> "hi" """
+    return " ".join(re.sub(r"[^\w\s]+", " ", text.lower()).split())
+
+
+def response_key(namespace, text, *context):
+    """
+    Cache key for an answer to text. Anything else the answer depends on
+    (system prompt, booking context) goes into context and is hashed.
+    """
+    digest = hashlib.sha1(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return f"{namespace}:{digest}:{normalize_question(text)}"
+
+
+class ResponseCache:
+    """
+    LRU cache of LLM answers for prompts whose answer only depends on the
+    normalized question, such as small talk. Entries expire after ttl seconds
+    and the least recently used ones are evicted past max_entries.
+    With a path the cache is loaded at startup and saved on shutdown, so it
+    survives restarts. A disabled cache never hits and stores nothing.
+    """
+
+    def __init__(self, ttl=24 * 3600, max_entries=10000, max_answer_chars=2000, path=None, enabled=True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_answer_chars = max_answer_chars
+        self.path = path
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, answer):
+        if not self.enabled or not answer or len(answer) > self.max_answer_chars:
+            return
+
+        self._entries[key] = (answer, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as error:
+            print(f"Could not load the response cache from {self.path}: {error}")
+            return
+
+        now = time.time()
+        for key, answer, stored_at in entries[-self.max_entries:]:
+            if now - stored_at < self.ttl:
+                self._entries[key] = (answer, stored_at)
+
+        print(f"Loaded {len(self._entries)} cached responses")
+
+    def save(self):
+        """Write the cache to its path, replacing the file atomically"""
+        if not self.path or not self.enabled:
+            return
+
+        entries = [[key, answer, stored_at] for key, (answer, stored_at) in self._entries.items()]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
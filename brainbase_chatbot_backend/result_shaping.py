@@ -0,0 +1,171 @@
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    # Without NumPy the same scores are computed in plain Python
+    np = None
+
+
+# Summaries sent to the client per page of results
+DEFAULT_PAGE_SIZE = 10
+
+# Weights of the normalized flight ranking criteria, lower scores rank first
+DEFAULT_FLIGHT_WEIGHTS = {'price': 1.0, 'duration': 0.5, 'departure': 0.3}
+
+# Preferred departure hour for a time of day the user asks to leave at. The
+# time of day must come with a departure ("a morning flight", "leave in the
+# evening"), so greetings such as "good morning" do not count.
+_DEPARTING = r"(?:fly|flying|flights?|leave|leaving|depart|departing|departure|take off|taking off|travel|travell?ing)"
+_TIMES_OF_DAY = [
+    (r"early[ -]morning", 6),
+    (r"morning", 9),
+    (r"noon|midday|lunch ?time", 12),
+    (r"afternoon", 15),
+    (r"evening", 19),
+    (r"night", 22),
+]
+DEPARTURE_HOURS = [
+    (re.compile(rf"\b(?:{times})[ -](?:flights?|departures?|planes?)\b"
+                rf"|\b{_DEPARTING}\b(?: [\w-]+){{0,3}}? (?:{times})\b"), hour)
+    for times, hour in _TIMES_OF_DAY
+] + [(re.compile(r"\bred[ -]?eyes?\b|\bovernight (?:flights?|departures?)\b"), 22)]
+
+_DURATION = re.compile(r"^PT(?:(\d+)H)?(?:(\d+)M)?$")
+
+
+def parse_duration(text):
+    """ISO 8601 duration of an itinerary in minutes: "PT10H30M" -> 630"""
+    match = _DURATION.match(text or "")
+    if not match:
+        return None
+    hours, minutes = match.groups()
+    return int(hours or 0) * 60 + int(minutes or 0)
+
+
+def summarize_flight(offer):
+    """Compact summary of an Amadeus flight offer, the fields a result card shows"""
+    itinerary = offer['itineraries'][0]
+    segments = itinerary['segments']
+    first, last = segments[0], segments[-1]
+    price = offer.get('price', {})
+    return {
+        'id': offer['id'],
+        'origin': first['departure']['iataCode'],
+        'destination': last['arrival']['iataCode'],
+        'departure': first['departure']['at'],
+        'arrival': last['arrival']['at'],
+        'carrier': first['carrierCode'],
+        'flight_number': f"{first['carrierCode']}{first['number']}",
+        'duration': parse_duration(itinerary.get('duration')),
+        'stops': len(segments) - 1 + sum(segment.get('numberOfStops', 0) for segment in segments),
+        'price': float(price.get('grandTotal') or price.get('total') or 0),
+        'currency': price.get('currency', 'USD'),
+    }
+
+
+def summarize_hotel(hotel):
+    """Compact summary of an Amadeus hotel, the fields a result card shows"""
+    geo = hotel.get('geoCode', {})
+    distance = hotel.get('distance', {})
+    return {
+        'id': hotel['hotelId'],
+        'name': hotel.get('name', ''),
+        'chain': hotel.get('chainCode'),
+        'city': hotel.get('iataCode'),
+        'latitude': geo.get('latitude'),
+        'longitude': geo.get('longitude'),
+        'country': hotel.get('address', {}).get('countryCode'),
+        'distance': distance.get('value'),
+    }
+
+
+def departure_preference(text):
+    """Preferred departure hour asked for in text ("a morning flight" -> 9), or None"""
+    text = text.lower()
+    for pattern, hour in DEPARTURE_HOURS:
+        if pattern.search(text):
+            return hour
+    return None
+
+
+def rank_flights(summaries, preferred_hour=None, weights=None):
+    """
+    Order flight summaries best first. Price, duration and the distance of the
+    departure time from preferred_hour are each scaled to 0..1 over the result
+    set and summed with their weights; without a preferred hour the departure
+    time does not count. Returns the indices of summaries in ranked order.
+    """
+    if not summaries:
+        return []
+    weights = {**DEFAULT_FLIGHT_WEIGHTS, **(weights or {})}
+    if preferred_hour is None:
+        weights['departure'] = 0.0
+
+    prices = [summary['price'] for summary in summaries]
+    durations = [summary['duration'] if summary['duration'] is not None else 0 for summary in summaries]
+    hours = [_hour_of_day(summary['departure']) for summary in summaries]
+
+    if np is not None:
+        prices = np.asarray(prices, dtype=float)
+        durations = np.asarray(durations, dtype=float)
+        hour_gap = np.abs(np.asarray(hours, dtype=float) - (preferred_hour or 0))
+        # Hours wrap around midnight, 23:00 is one hour from 00:00
+        hour_gap = np.minimum(hour_gap, 24 - hour_gap) / 12
+        scores = (weights['price'] * _scale(prices) + weights['duration'] * _scale(durations)
+                  + weights['departure'] * hour_gap)
+        return np.argsort(scores, kind='stable').tolist()
+
+    hour_gaps = [min(abs(hour - (preferred_hour or 0)), 24 - abs(hour - (preferred_hour or 0))) / 12 for hour in hours]
+    scores = [
+        weights['price'] * price + weights['duration'] * duration + weights['departure'] * gap
+        for price, duration, gap in zip(_scale_list(prices), _scale_list(durations), hour_gaps)
+    ]
+    return sorted(range(len(scores)), key=scores.__getitem__)
+
+
+def rank_hotels(summaries):
+    """Order hotel summaries by distance from the city centre, unknown distances last"""
+    distances = [summary['distance'] if summary['distance'] is not None else float('inf') for summary in summaries]
+    if np is not None:
+        return np.argsort(np.asarray(distances, dtype=float), kind='stable').tolist()
+    return sorted(range(len(distances)), key=distances.__getitem__)
+
+
+def shape_results(kind, items, preferred_hour=None):
+    """
+    Project raw Amadeus results to ranked summaries. Returns the summaries
+    best first and the full items by id, for results_store.ResultsStore.
+    """
+    if kind == 'flights':
+        summaries = [summarize_flight(item) for item in items]
+        order = rank_flights(summaries, preferred_hour)
+    else:
+        summaries = [summarize_hotel(item) for item in items]
+        order = rank_hotels(summaries)
+
+    return {
+        'summaries': [summaries[index] for index in order],
+        'details': {summary['id']: item for summary, item in zip(summaries, items)},
+    }
+
+
+def _hour_of_day(timestamp):
+    # "2025-05-01T14:30:00" -> 14.5
+    try:
+        hours, minutes = timestamp[11:16].split(':')
+        return int(hours) + int(minutes) / 60
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _scale(values):
+    low = values.min()
+    span = values.max() - low
+    return (values - low) / span if span > 0 else np.zeros_like(values)
+
+
+def _scale_list(values):
+    low = min(values)
+    span = max(values) - low
+    return [(value - low) / span if span > 0 else 0.0 for value in values]
@@ -0,0 +1,151 @@
+import asyncio
+import itertools
+import json
+import math
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import zlib
+from array import array
+
+
+# Summary fields kept in typed arrays, None is stored as NaN
+NUMERIC_FIELDS = {'duration', 'stops', 'price', 'latitude', 'longitude', 'distance'}
+
+# Numeric fields that are whole numbers in the summaries
+INTEGER_FIELDS = {'duration', 'stops'}
+
+
+class SearchResults:
+    """
+    Ranked summaries of one flight or hotel search, stored column by column:
+    numbers in typed arrays and strings in tuples (repeated values such as
+    airport or carrier codes share one string), instead of a dict per offer.
+    The full offers live in the ResultsStore and are loaded one at a time.
+    """
+
+    __slots__ = ('store', 'result_id', 'kind', 'fields', 'columns', 'count', 'nbytes')
+
+    def __init__(self, store, result_id, kind, summaries):
+        self.store = store
+        self.result_id = result_id
+        self.kind = kind
+        self.fields = tuple(summaries[0]) if summaries else ()
+        self.count = len(summaries)
+        self.columns = {}
+        for field in self.fields:
+            values = [summary[field] for summary in summaries]
+            if field in NUMERIC_FIELDS:
+                self.columns[field] = array('d', [math.nan if value is None else value for value in values])
+            else:
+                self.columns[field] = tuple(sys.intern(value) if isinstance(value, str) else value for value in values)
+        # Shared strings are counted once
+        strings = {id(value): value for column in self.columns.values() for value in column if isinstance(value, str)}
+        self.nbytes = (sys.getsizeof(self) + sum(sys.getsizeof(column) for column in self.columns.values())
+                       + sum(sys.getsizeof(value) for value in strings.values()))
+
+    def __len__(self):
+        return self.count
+
+    def row(self, index):
+        """Summary dict of the result at a ranked position"""
+        summary = {}
+        for field in self.fields:
+            value = self.columns[field][index]
+            if field in NUMERIC_FIELDS:
+                value = None if math.isnan(value) else int(value) if field in INTEGER_FIELDS else value
+            summary[field] = value
+        return summary
+
+    def page(self, page, page_size):
+        """One page of summaries and the paging fields sent with it"""
+        start = page * page_size
+        return {
+            'data': [self.row(index) for index in range(start, min(start + page_size, self.count))],
+            'page': page,
+            'page_size': page_size,
+            'total': self.count,
+            'has_more': start + page_size < self.count,
+        }
+
+    async def details(self, item_id):
+        """The full Amadeus offer or hotel behind a summary, None if it is unknown"""
+        return await self.store.load(self.result_id, item_id)
+
+    def release(self):
+        """Drop the full offers, called when the conversation store lets go of the results"""
+        self.store.discard(self.result_id)
+
+
+class ResultsStore:
+    """
+    Disk-backed store for the full search results, so conversations only keep
+    compact summaries in memory. Offers are kept zlib-compressed in SQLite,
+    addressed by (result id, item id), and read when a sheet asks for them.
+    The data does not outlive the process: the table is emptied on start and a
+    temporary database file is removed on close.
+
+    SQLite calls run in a worker thread so the event loop never waits on disk,
+    deletes of released results are batched into the next write.
+    """
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='brainbase-results-', suffix='.sqlite3')
+            os.close(handle)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Losing the file on a crash only loses results of this process, no need to fsync
+        self._db.execute('PRAGMA synchronous=OFF')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS results (result_id INTEGER, item_id TEXT, body BLOB, '
+            'PRIMARY KEY (result_id, item_id)) WITHOUT ROWID'
+        )
+        with self._db:
+            self._db.execute('DELETE FROM results')
+        self._result_ids = itertools.count(1)
+        self._discarded = []
+
+    async def save(self, kind, shaped):
+        """Store the output of result_shaping.shape_results, returns its SearchResults"""
+        result_id = next(self._result_ids)
+        discarded, self._discarded = self._discarded, []
+        await asyncio.to_thread(self._write, result_id, shaped['details'], discarded)
+        return SearchResults(self, result_id, kind, shaped['summaries'])
+
+    async def load(self, result_id, item_id):
+        body = await asyncio.to_thread(self._read, result_id, item_id)
+        return json.loads(zlib.decompress(body)) if body is not None else None
+
+    def discard(self, result_id):
+        self._discarded.append(result_id)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+        if self.temporary:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+    def _write(self, result_id, details, discarded):
+        rows = [
+            (result_id, str(item_id), zlib.compress(json.dumps(item, separators=(',', ':')).encode()))
+            for item_id, item in details.items()
+        ]
+        with self._lock, self._db:
+            if discarded:
+                self._db.executemany('DELETE FROM results WHERE result_id = ?', [(old_id,) for old_id in discarded])
+            self._db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', rows)
+
+    def _read(self, result_id, item_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body FROM results WHERE result_id = ? AND item_id = ?', (result_id, str(item_id))
+            ).fetchone()
+        return row[0] if row else None
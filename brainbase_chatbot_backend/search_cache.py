@@ -0,0 +1,127 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'fetched_at')
+
+    def __init__(self, value, size, fetched_at):
+        self.value = value
+        self.size = size
+        self.fetched_at = fetched_at
+
+
+class SearchCache:
+    """
+    TTL cache for upstream search results with stale-while-revalidate.
+    A fresh entry is returned as is. An entry past its TTL but still inside the
+    stale window is returned immediately while one background refresh replaces it.
+    Entries are evicted least recently used first once the cache goes over
+    max_bytes (measured as the size of the JSON encoded value).
+    """
+
+    def __init__(self, ttl=300, stale_ttl=900, max_bytes=32 * 1024 * 1024, should_cache=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.should_cache = should_cache or (lambda value: True)
+        self._entries = OrderedDict()
+        self._refreshing = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_failures = 0
+
+    async def get_or_fetch(self, key, fetch):
+        """
+        Return the cached value for key, calling fetch() on a miss.
+        fetch must be a zero argument coroutine function so a background
+        refresh can call it again later.
+        """
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.value
+
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._refresh_in_background(key, fetch)
+                return entry.value
+
+            self._remove(key)
+
+        self.misses += 1
+        value = await fetch()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if not self.should_cache(value):
+            return
+
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = _Entry(value, size, time.monotonic())
+        self.size_bytes += size
+
+        while self.size_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry.size
+
+    def _refresh_in_background(self, key, fetch):
+        if key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                self.set(key, await fetch())
+            except Exception as error:
+                self.refresh_failures += 1
+                print(f"Background refresh failed for {key}: {error}")
+            finally:
+                self._refreshing.pop(key, None)
+
+        self._refreshing[key] = asyncio.ensure_future(refresh())
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size_bytes': self.size_bytes,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'refresh_failures': self.refresh_failures,
+        }
+
+
+def flight_offer_key(origin, destination, date, adults=1, non_stop=True, currency="USD"):
+    """Cache key for a flight offer search, normalized so equivalent searches share an entry"""
+    return (
+        'flight_offers',
+        origin.strip().upper(),
+        destination.strip().upper(),
+        date.strip(),
+        int(adults),
+        bool(non_stop),
+        currency.strip().upper(),
+    )
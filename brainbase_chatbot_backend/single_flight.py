@@ -0,0 +1,36 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for a key is in flight,
+    later callers with the same key await that call instead of starting their
+    own, and every waiter receives the same result (or exception).
+    The result object is shared between waiters, so it must not be mutated.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done_task: self._forget(key, done_task))
+        else:
+            self.coalesced += 1
+
+        # Shield the shared call so one cancelled waiter doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,176 @@
+import re
+from datetime import date as Date
+
+from trip_extraction import REQUIRED_SLOTS, SLOT_FIELDS
+
+
+CITY_FIELDS = ("origin", "destination")
+
+# A place name: words up to the next preposition
+_PLACE = r"([a-z](?:(?!\b(?:to|in|from|on|for)\b)[a-z .'-])*?)"
+_ROUTE = re.compile(rf"\bfrom {_PLACE} to {_PLACE}(?= on\b| for\b| in\b|$)")
+_ORIGIN = re.compile(rf"\bfrom {_PLACE}(?= on\b| for\b| to\b|$)")
+_DESTINATION = re.compile(rf"\b(?:to|in) {_PLACE}(?= on\b| for\b| from\b|$)")
+_LEADING_WORDS = re.compile(r"^(?:(?:i want to go|i am going|im going|going|flying|travelling|traveling|to|from|in|at|it is|its)\s+)+")
+_TRAILING_WORDS = re.compile(r"(?:\s+(?:on|for|in|please|thanks|thank you))+$")
+
+_ISO_DATE = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+_US_DATE = re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4})\b")
+_MONTHS = ["january", "february", "march", "april", "may", "june", "july",
+           "august", "september", "october", "november", "december"]
+_MONTH = r"(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*"
+_MONTH_DAY = re.compile(rf"\b{_MONTH}\.? (\d{{1,2}})(?:st|nd|rd|th)?(?:,? (\d{{4}}))?\b")
+_DAY_MONTH = re.compile(rf"\b(\d{{1,2}})(?:st|nd|rd|th)?(?: of)? {_MONTH}\.?(?:,? (\d{{4}}))?\b")
+_TRAVELLERS = re.compile(r"\b(\d{1,2}) ?(?:people|persons|adults|travell?ers|passengers|tickets|of us)\b")
+
+
+def normalize_text(text):
+    return " ".join(re.sub(r"[^a-z0-9/ '-]+", " ", text.lower()).replace("'", "").split())
+
+
+def extract_slot_phrases(text):
+    """
+    Route, destination and date phrases and the traveller count of a
+    normalized message: "from boston to paris on 2025-05-01 for 2 people"
+    """
+    slots = {}
+    route = _ROUTE.search(text)
+    if route:
+        slots["origin"], slots["destination"] = route.group(1).strip(), route.group(2).strip()
+    else:
+        origin = _ORIGIN.search(text)
+        if origin:
+            slots["origin"] = origin.group(1).strip()
+        destination = _DESTINATION.search(text)
+        if destination:
+            slots["destination"] = destination.group(1).strip()
+
+    _, date = parse_date(text)
+    if date:
+        slots["date"] = date
+
+    travellers = _TRAVELLERS.search(text)
+    if travellers:
+        slots["travellers"] = int(travellers.group(1))
+    return slots
+
+
+def parse_date(text, today=None):
+    """
+    Find a travel date (ISO, 5/1/2025, "May 1st", "1 May 2025"), returns
+    (match, "YYYY-MM-DD") or (None, None). A date without a year is the next
+    one to come: on 2026-10-18 "may 3rd" is 2027-05-03 and "dec 5" 2026-12-05.
+    """
+    for pattern in (_ISO_DATE, _US_DATE, _MONTH_DAY, _DAY_MONTH):
+        match = pattern.search(text)
+        if not match:
+            continue
+
+        if pattern is _ISO_DATE:
+            year, month, day = (int(part) for part in match.groups())
+        elif pattern is _US_DATE:
+            month, day, year = (int(part) for part in match.groups())
+        elif pattern is _MONTH_DAY:
+            month, day, year = _month_number(match.group(1)), int(match.group(2)), match.group(3)
+        else:
+            day, month, year = int(match.group(1)), _month_number(match.group(2)), match.group(3)
+
+        try:
+            date = Date(int(year), month, day) if year else next_occurrence(month, day, today)
+        except ValueError:
+            continue
+        return match, date.isoformat()
+
+    return None, None
+
+
+def next_occurrence(month, day, today=None):
+    """The first date on or after today falling on month/day, raises ValueError for an impossible day"""
+    today = today or Date.today()
+    # February 29th can be up to four years away
+    for year in range(today.year, today.year + 5):
+        try:
+            date = Date(year, month, day)
+        except ValueError:
+            if month == 2 and day == 29:
+                continue
+            raise
+        if date >= today:
+            return date
+    raise ValueError(f"No date for {month}/{day}")
+
+
+def _clean_place(name):
+    return _TRAILING_WORDS.sub("", name).strip(" .,-")
+
+
+def _month_number(name):
+    return next(index for index, month in enumerate(_MONTHS, start=1) if month.startswith(name[:3]))
+
+
+class TripSlots:
+    """
+    Trip details of a conversation, filled in incrementally as the user
+    answers. Resolved IATA codes are kept next to the city names so the
+    flight and hotel searches resolve each city once; changing a city drops
+    its code. `asked` is the detail the last question asked for, `messages`
+    the user messages about this trip: the request and the answers to it.
+    """
+
+    __slots__ = ('filled', 'codes', 'asked', 'messages')
+
+    def __init__(self, values=None, request=None):
+        self.filled = {}
+        self.codes = {}
+        self.asked = None
+        self.messages = [request] if isinstance(request, str) else []
+        self.update(values or {})
+
+    def get(self, field):
+        return self.filled.get(field)
+
+    def update(self, values):
+        for field, value in values.items():
+            if field in SLOT_FIELDS and value and value != self.filled.get(field):
+                self.filled[field] = value
+                self.codes.pop(field, None)
+
+    def missing(self, categories):
+        """Details the categories need that are not filled yet, in slot order"""
+        needed = {field for category in categories for field in REQUIRED_SLOTS.get(category, ())}
+        return [field for field in SLOT_FIELDS if field in needed and not self.filled.get(field)]
+
+    def fill_from_message(self, message, missing, is_known_city):
+        """
+        Fill the missing details the newest message answers, without a model
+        call. Cities are only accepted when is_known_city(name) knows them.
+        A traveller count is taken even when it is not missing, so "make it
+        3 people" changes the party size. Returns the details that were filled.
+        """
+        text = normalize_text(message)
+        found = {}
+
+        date_match, date = parse_date(text)
+        if date and "date" in missing:
+            found["date"] = date
+        if date_match:
+            text = (text[:date_match.start()] + text[date_match.end():]).strip()
+
+        travellers = _TRAVELLERS.search(text)
+        if travellers:
+            found["travellers"] = int(travellers.group(1))
+
+        phrases = {field: _clean_place(place) for field, place in extract_slot_phrases(text).items() if field in CITY_FIELDS}
+        for field in CITY_FIELDS:
+            if field in missing and phrases.get(field) and is_known_city(phrases[field]):
+                found[field] = phrases[field]
+
+        # A bare city name answers the question that was asked, or the destination
+        city_fields = [field for field in (self.asked, *CITY_FIELDS) if field in CITY_FIELDS and field in missing]
+        city_fields = [field for field in city_fields if field not in found]
+        bare_city = _clean_place(_LEADING_WORDS.sub("", text))
+        if city_fields and not phrases and bare_city and is_known_city(bare_city):
+            found[city_fields[0]] = bare_city
+
+        self.update(found)
+        return found
@@ -0,0 +1,163 @@
+import asyncio
+import contextvars
+
+
+# (run, task name) of the scheduled task the current coroutine belongs to
+_current_task = contextvars.ContextVar('scheduled_task', default=None)
+
+
+class TaskSpec:
+    """
+    Describes one category task: the inputs it needs, the inputs it provides
+    to other tasks, and the tasks that have to be completed before it starts.
+    """
+
+    __slots__ = ('name', 'needs', 'provides', 'after')
+
+    def __init__(self, name, needs=(), provides=(), after=()):
+        self.name = name
+        self.needs = tuple(needs)
+        self.provides = tuple(provides)
+        self.after = tuple(after)
+
+
+class TaskScheduler:
+    """
+    Runs the category tasks of a request as a dependency graph.
+    Every task starts as soon as the tasks it runs after are completed and the
+    inputs it needs were provided by the tasks of the same run that produce
+    them, so independent tasks (e.g. flights and hotels) run concurrently.
+    A task whose inputs never arrive is deferred to a later turn.
+    Events emitted by the tasks reach the client in the order of the request:
+    the earliest unfinished task sends live, later ones are buffered until
+    the tasks before them are finished.
+    """
+
+    def __init__(self, specs):
+        self.specs = {spec.name: spec for spec in specs}
+
+    async def run(self, names, run_task, is_done, send, has_input=None):
+        """
+        Run the tasks in names that are not done yet.
+        run_task(name) runs one task, is_done(name) reports whether a task is
+        completed and send(*args) delivers one event to the client.
+        has_input(name), when given, reports inputs that are already known
+        before the run starts, tasks needing only those don't wait for a provider.
+        Raises the first task error once every task has finished.
+        """
+        order = [name for name in names if name in self.specs and not is_done(name)]
+        if not order:
+            return
+
+        task_run = _Run(self, order, run_task, is_done, send)
+        if has_input is not None:
+            task_run.provided.update(needed for name in order for needed in self.specs[name].needs if has_input(needed))
+        results = await asyncio.gather(*(task_run.start(name) for name in order), return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+class _Run:
+
+    def __init__(self, scheduler, order, run_task, is_done, send):
+        self.specs = scheduler.specs
+        self.order = order
+        self.run_task = run_task
+        self.is_done = is_done
+        self.send = send
+        self.finished = set()
+        self.provided = set()
+        self.changed = asyncio.Condition()
+        self.buffers = {name: [] for name in order}
+        self.output_head = 0
+        self.send_lock = asyncio.Lock()
+
+    async def start(self, name):
+        # gather runs each task with its own copy of the context
+        _current_task.set((self, name))
+        spec = self.specs[name]
+
+        try:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self._readiness(spec) is not None)
+                ready = self._readiness(spec)
+
+            if ready:
+                return await self.run_task(name)
+
+            print(f"Deferring task {name}, its inputs are not available yet")
+        finally:
+            async with self.changed:
+                self.finished.add(name)
+                self.changed.notify_all()
+            await self._finish_output(name)
+
+    def _readiness(self, spec):
+        """True when the task can start, False when it never will in this run, None to keep waiting"""
+        for dependency in spec.after:
+            if dependency not in self.order:
+                continue
+            if dependency not in self.finished:
+                return None
+            if not self.is_done(dependency):
+                return False
+
+        for needed in spec.needs:
+            providers = [name for name in self.order if name != spec.name and needed in self.specs[name].provides]
+            # Without a provider in this run the task collects its own inputs
+            if not providers or needed in self.provided:
+                continue
+            if any(name not in self.finished for name in providers):
+                return None
+            return False
+
+        return True
+
+    async def provide(self, inputs):
+        async with self.changed:
+            self.provided.update(inputs)
+            self.changed.notify_all()
+
+    async def emit(self, name, args):
+        async with self.send_lock:
+            if self.output_head < len(self.order) and self.order[self.output_head] == name:
+                await self.send(*args)
+            else:
+                self.buffers[name].append(args)
+
+    async def _finish_output(self, name):
+        async with self.send_lock:
+            self.buffers[name].append(None)
+
+            # Release buffered output of the following tasks, in request order
+            while self.output_head < len(self.order):
+                head = self.order[self.output_head]
+                buffer = self.buffers[head]
+                while buffer and buffer[0] is not None:
+                    await self.send(*buffer.pop(0))
+                if not buffer:
+                    break
+                self.output_head += 1
+
+
+async def emit_in_task_order(*args):
+    """
+    Send an event through the ordered output of the scheduled task the caller
+    runs in. Returns False when the caller is not part of a scheduled run.
+    """
+    current = _current_task.get()
+    if current is None:
+        return False
+
+    task_run, name = current
+    await task_run.emit(name, args)
+    return True
+
+
+async def provide_inputs(*inputs):
+    """Tell tasks waiting in the same run that these inputs are now available"""
+    current = _current_task.get()
+    if current is not None:
+        await current[0].provide(inputs)
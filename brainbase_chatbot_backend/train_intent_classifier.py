@@ -0,0 +1,54 @@
+"""
+Train the bag-of-words intent model used by the local fast path.
+
+    python train_intent_classifier.py [examples.json] [model.json]
+
+Examples are a JSON list of {"text": ..., "label": ...} objects, labels are
+category lists joined with '+'. Prints the leave-one-out accuracy and the
+share of examples that would clear the confidence threshold.
+"""
+import json
+import os
+import sys
+
+from intent_classifier import DEFAULT_MODEL_PATH, DEFAULT_THRESHOLD, IntentClassifier, train
+
+
+DEFAULT_EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'intent_examples.json')
+
+
+def evaluate(examples, threshold):
+    """Leave-one-out accuracy overall and above the threshold"""
+    correct = confident = confident_correct = 0
+    classifier = IntentClassifier(model_path=None, threshold=threshold)
+
+    for index, (text, label) in enumerate(examples):
+        classifier.model = train(examples[:index] + examples[index + 1:])
+        prediction = classifier.classify(text)
+        predicted = "+".join(prediction.categories)
+        correct += predicted == label
+        if prediction.confidence >= threshold:
+            confident += 1
+            confident_correct += predicted == label
+
+    print(f"Leave-one-out accuracy: {correct / len(examples):.2%}")
+    print(f"Above threshold {threshold}: {confident / len(examples):.2%} of examples, "
+          f"{confident_correct / max(confident, 1):.2%} correct")
+
+
+def main():
+    examples_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_EXAMPLES_PATH
+    model_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_MODEL_PATH
+
+    with open(examples_path) as f:
+        examples = [(example['text'], example['label']) for example in json.load(f)]
+
+    evaluate(examples, DEFAULT_THRESHOLD)
+
+    with open(model_path, 'w') as f:
+        json.dump(train(examples), f)
+    print(f"Wrote {model_path} from {len(examples)} examples")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+from model_output import ModelOutputError, loads, validate
+
+
+TRIP_CATEGORIES = ["Flights", "Hotels", "Transports", "Experiences", "Generic"]
+SLOT_FIELDS = ("origin", "destination", "date", "travellers")
+
+# Slots each category needs before its search can run
+REQUIRED_SLOTS = {
+    "Flights": ("origin", "destination", "date"),
+    "Hotels": ("destination", "date"),
+}
+
+TRIP_REQUEST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "categories": {
+            "type": "array",
+            "items": {"type": "string", "enum": TRIP_CATEGORIES}
+        },
+        "origin": {"type": ["string", "null"]},
+        "destination": {"type": ["string", "null"]},
+        "date": {"type": ["string", "null"]},
+        "travellers": {"type": ["integer", "null"]},
+        "missing": {
+            "type": "array",
+            "items": {"type": "string", "enum": list(SLOT_FIELDS)}
+        }
+    },
+    "required": ["categories", *SLOT_FIELDS, "missing"],
+    "additionalProperties": False
+}
+
+# Structured output format for the extraction call
+TRIP_REQUEST_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "trip_request",
+        "strict": True,
+        "schema": TRIP_REQUEST_SCHEMA
+    }
+}
+
+EXTRACTION_PROMPT = '''You are a helpful trip planner assistant. From the conversation you will identify which tasks
+the latest message asks for, out of Flights, Transports, Hotels and Experiences, and collect the trip details.
+
+Categories:
+User: I want to book a flight to New York. -> ["Flights"]
+User: I want to book a hotel in New York. -> ["Hotels"]
+User: I want to book a transport from New York to Los Angeles. -> ["Transports"]
+User: I want to book a flight to New York and a hotel in New York. -> ["Flights", "Hotels"]
+User: Plan a trip from San Francisco to New York. -> ["Flights", "Hotels"]
+User: Hi, How are you? -> ["Generic"]
+
+Trip details:
+- origin: city the user travels from
+- destination: city the user travels to
+- date: travel date in YYYY-MM-DD format
+- travellers: number of travellers
+Use null for every detail that is not in the conversation, do not guess.
+List the details the requested categories still need in "missing".'''
+
+SLOT_PROMPT = '''You are a trip planner assistant. The user was asked for missing trip details.
+Extract only these details from the user's latest message: {fields}.
+- origin: city the user travels from
+- destination: city the user travels to
+- date: travel date in YYYY-MM-DD format
+- travellers: number of travellers
+Use null for every detail the message does not give, do not guess.'''
+
+PLAN_STEPS = {
+    "Flights": [
+        "I'll search for flights from {origin} to {destination}.",
+        "I'll display the flights to you.",
+        "I'll book the flight for you.",
+    ],
+    "Hotels": [
+        "I'll search for hotels in {destination}.",
+        "I'll display the hotels to you.",
+        "I'll book the hotel for you.",
+    ],
+    "Transports": [
+        "I'll book a car from the airport to your hotel.",
+    ],
+    "Experiences": [
+        "I'll look for experiences in {destination}.",
+    ],
+}
+
+PLAN_NAMES = {
+    "Flights": "a flight",
+    "Hotels": "a hotel",
+    "Transports": "a transfer",
+    "Experiences": "experiences",
+}
+
+MISSING_QUESTIONS = {
+    "origin": "Where will you be travelling from?",
+    "destination": "Where would you like to go?",
+    "date": "What date would you like to travel? (YYYY-MM-DD)",
+}
+
+
+def build_extraction_messages(conversation_text, latest_message):
+    return [
+        {"role": "system", "content": EXTRACTION_PROMPT},
+        {"role": "user", "content": f"Conversation:\n{conversation_text}\n\nLatest message: {latest_message}"}
+    ]
+
+
+class TripRequest:
+    """Categories and trip details of one extraction answer, reply is a fixed answer to chit-chat"""
+
+    __slots__ = ('categories', 'origin', 'destination', 'date', 'travellers', 'missing', 'reply')
+
+    def __init__(self, categories, origin=None, destination=None, date=None, travellers=None, missing=(), reply=None):
+        self.categories = categories
+        self.origin = origin
+        self.destination = destination
+        self.date = date
+        self.travellers = travellers
+        self.missing = list(missing)
+        self.reply = reply
+
+    def slots(self):
+        """The trip details that were found"""
+        return {field: getattr(self, field) for field in SLOT_FIELDS if getattr(self, field)}
+
+    def __repr__(self):
+        return f"TripRequest(categories={self.categories}, slots={self.slots()}, missing={self.missing})"
+
+
+def _normalize_category(category):
+    # Repair near misses like "flight" or "HOTELS" instead of rejecting the answer
+    if isinstance(category, str):
+        for name in TRIP_CATEGORIES:
+            if category.strip().lower() in (name.lower(), name.lower().rstrip('s')):
+                return name
+    return category
+
+
+def slot_answer_format(fields):
+    """Structured output format for extracting only the given slots"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "trip_details",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {field: TRIP_REQUEST_SCHEMA["properties"][field] for field in fields},
+                "required": list(fields),
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def build_slot_messages(question, latest_message, fields):
+    return [
+        {"role": "system", "content": SLOT_PROMPT.format(fields=", ".join(fields))},
+        {"role": "assistant", "content": question or "Could you tell me more about your trip?"},
+        {"role": "user", "content": latest_message}
+    ]
+
+
+def parse_slot_answer(content, fields):
+    """Parse and validate a slot answer, returns the slots that were given"""
+    response = loads(content)
+    if not isinstance(response, dict):
+        raise ModelOutputError(f"Expected a JSON object, got {type(response).__name__}")
+
+    response = {field: response.get(field) for field in fields}
+    if isinstance(response.get("travellers"), str) and response["travellers"].strip().isdigit():
+        response["travellers"] = int(response["travellers"])
+    validate(response, slot_answer_format(fields)["json_schema"]["schema"])
+
+    return {field: value for field, value in response.items() if value}
+
+
+def parse_trip_request(content):
+    """
+    Parse and validate the extraction answer into a TripRequest.
+    Raises ModelOutputError when the answer can't be repaired.
+    """
+    response = loads(content)
+    if isinstance(response, list):
+        # A bare category list, as older prompts answered
+        response = {"categories": response}
+    if not isinstance(response, dict):
+        raise ModelOutputError(f"Expected a JSON object, got {type(response).__name__}")
+
+    # Models without strict structured outputs add fields of their own or leave out empty ones
+    response = {key: response.get(key) for key in TRIP_REQUEST_SCHEMA["properties"]}
+    response["categories"] = response["categories"] or []
+    response["missing"] = response["missing"] or []
+    if isinstance(response["categories"], list):
+        categories = [_normalize_category(category) for category in response["categories"]]
+        response["categories"] = [category for category in categories if category in TRIP_CATEGORIES]
+    if isinstance(response["missing"], list):
+        response["missing"] = [field for field in response["missing"] if field in SLOT_FIELDS]
+    if isinstance(response["travellers"], str) and response["travellers"].strip().isdigit():
+        response["travellers"] = int(response["travellers"])
+
+    validate(response, TRIP_REQUEST_SCHEMA)
+
+    trip = TripRequest(
+        response["categories"] or ["Generic"],
+        **{field: response[field] or None for field in SLOT_FIELDS}
+    )
+
+    missing = set(response["missing"])
+    for category in trip.categories:
+        missing.update(field for field in REQUIRED_SLOTS.get(category, ()) if not getattr(trip, field))
+    trip.missing = [field for field in SLOT_FIELDS if field in missing]
+
+    return trip
+
+
+def render_plan(categories, trip):
+    """Render the step by step plan for the requested categories"""
+    categories = [category for category in categories if category in PLAN_STEPS]
+    values = {
+        "origin": trip.get("origin") or "your origin",
+        "destination": trip.get("destination") or "your destination",
+    }
+
+    names = [PLAN_NAMES[category] for category in categories]
+    if len(names) > 1:
+        names = [", ".join(names[:-1]) + " and " + names[-1]]
+
+    lines = [f"I'll take the following steps to book {names[0] if names else 'your trip'} for you:"]
+    steps = [step.format(**values) for category in categories for step in PLAN_STEPS[category]]
+    lines.extend(f"{index}. {step}" for index, step in enumerate(steps, start=1))
+
+    return "\n".join(lines)
+
+
+def missing_question(field):
+    return MISSING_QUESTIONS.get(field, f"Could you tell me the {field} for your trip?")